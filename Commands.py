@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import datetime
 import FreeCADGui as Gui
 import FreeCAD
 from PySide import QtGui
 from libs.FreeCADComponents import ComponentsStore, SubjectStore, Subject, Detector, LightSource, ViewProviderDetector, ViewProviderLightSource
+from libs.projectionStore import ProjectionStore
 
 _icondir_ = os.path.join(os.path.dirname(__file__), 'resources')
 
+def _get_proxy_type(obj):
+    # 他のワークベンチのFeaturePythonはProxyやTypeを持たない場合がある
+    return getattr(getattr(obj, "Proxy", None), "Type", None)
+
 class ConvertSubjectCommand():
     '''This class will be loaded when the workbench is activated in FreeCAD. You must restart FreeCAD to apply changes in this class'''  
     convertable_parts = []
@@ -19,11 +26,16 @@ class ConvertSubjectCommand():
         '''Will be called when the feature is executed.'''
         self.prepare()
 
-        objects = Gui.Selection.getSelection()
-        for obj in objects:
-            self.process_object(obj)
+        # ツリーのルートからの経路付きで選択を取得し、App::Linkを経由した配置も辿れるようにする
+        for sel in Gui.Selection.getSelectionEx('', 0):
+            # サブ要素(Face1など)が選択された場合は、それを含むオブジェクトまでの経路にする
+            subnames = [sub[:sub.rfind('.') + 1] for sub in sel.SubElementNames] or [""]
+            for subname in dict.fromkeys(subnames):
+                obj = sel.Object.getSubObject(subname, retType=1) if subname else sel.Object
+                if obj is not None:
+                    self.process_object(obj, sel.Object, subname)
 
-        for part in self.convertable_parts:
+        for part, root, subname, link in self.convertable_parts:
             # カスタムPartを指定した場合は無視
             if hasattr(part, "Proxy") and part.Proxy and part.Proxy.Type:
                 if part.Proxy.Type == "Subject":
@@ -39,14 +51,18 @@ class ConvertSubjectCommand():
                     continue
 
             # 変換済みのPartを指定した場合は無視
-            unique_label = f"s_{part.Label}{part.ID}"
+            # 同じ部品を複数のLinkで配置する場合があるので、Linkを経由した場合はLinkのIDで区別する
+            unique_label = f"s_{part.Label}{part.ID}" if link is None else f"s_{part.Label}{link.ID}"
             if FreeCAD.ActiveDocument.getObject(unique_label):
                 FreeCAD.Console.PrintMessage(f"already converted.\n")
                 continue
 
             # カスタムPartを生成
             fp = FreeCAD.ActiveDocument.addObject("Part::FeaturePython", unique_label)
-            Subject(fp, part)
+            if link is None:
+                Subject(fp, part)
+            else:
+                Subject(fp, part, root, subname)
 
         FreeCAD.ActiveDocument.recompute()
 
@@ -71,15 +87,28 @@ class ConvertSubjectCommand():
     def prepare(self):
         self.convertable_parts = []
 
-    def process_object(self, obj):
+    def process_object(self, obj, root=None, subname="", link=None):
+        # subnameはrootからobjまでの経路。linkは経路上で最初に通ったApp::Link
+        if root is None:
+            root = obj
+
+        if obj.isDerivedFrom("App::Link"):
+            # Assembly4などで(別ドキュメントの)部品を配置するLinkは、同じ経路のままリンク先を展開する
+            linked = obj.getLinkedObject(True)
+            if linked is None or linked == obj:
+                return
+            if link is None:
+                link = obj
+            obj = linked
+
         if obj.isDerivedFrom("Part::Feature"):
             # FreeCAD.Console.PrintMessage(f"This is convertable.\n")
-            self.convertable_parts.append(obj)
+            self.convertable_parts.append((obj, root, subname, link))
 
         # 子要素を再帰的に処理する
         elif hasattr(obj, 'Group') and obj.Group:
             for child in obj.Group:
-                self.process_object(child)
+                self.process_object(child, root, f"{subname}{child.Name}.", link)
 
 class CreateOpticalSystemCommand():
 
@@ -91,15 +120,14 @@ class CreateOpticalSystemCommand():
         '''Will be called when the feature is executed.'''
 
         # カスタムPartを生成
-        if FreeCAD.ActiveDocument.getObject(self.lightsource_name) is None:
-            ls_fp = FreeCAD.ActiveDocument.addObject("Part::FeaturePython", self.lightsource_name)
-            LightSource(ls_fp)
-            ViewProviderLightSource(ls_fp.ViewObject)
+        # 2組目以降は名前に連番が付く(LightSource001, Detector001, ...)
+        ls_fp = FreeCAD.ActiveDocument.addObject("Part::FeaturePython", self.lightsource_name)
+        LightSource(ls_fp)
+        ViewProviderLightSource(ls_fp.ViewObject)
 
-        if FreeCAD.ActiveDocument.getObject(self.detector_name) is None:
-            det_fp = FreeCAD.ActiveDocument.addObject("Part::FeaturePython", self.detector_name)
-            Detector(det_fp)
-            ViewProviderDetector(det_fp.ViewObject)
+        det_fp = FreeCAD.ActiveDocument.addObject("Part::FeaturePython", self.detector_name)
+        Detector(det_fp, ls_fp)
+        ViewProviderDetector(det_fp.ViewObject)
 
         FreeCAD.ActiveDocument.recompute()
 
@@ -109,10 +137,6 @@ class CreateOpticalSystemCommand():
         if FreeCAD.ActiveDocument is None:
             return False
         
-        if FreeCAD.ActiveDocument.getObject(self.lightsource_name):
-            # FreeCAD.Console.PrintMessage(f"already created.\n")
-            return False
-        
         return True
         
     def GetResources(self):
@@ -127,11 +151,12 @@ class AcquireXRayImageCommand():
 
     def __init__(self) -> None:
         try:
-            import libs.gvxrEngine as gvxrEx
+            # 撮影は常駐するレンダーサーバーで行い、FreeCADのプロセスではgvxrを読み込まない
+            import libs.renderClient as renderClient
             import matplotlib.pyplot as plt
             import numpy as np
             self.can_compute_xray = True
-            self.engine = gvxrEx.Engine()
+            self.client = renderClient.RenderClient()
 
         except Exception as ex:
             self.can_compute_xray = False
@@ -151,34 +176,58 @@ class AcquireXRayImageCommand():
 
         # Subjectを探索する
         r = FreeCAD.ActiveDocument.findObjects("Part::FeaturePython")
-        subjects = [fp for fp in r if fp.Proxy.Type == "Subject"]
+        subjects = [fp for fp in r if _get_proxy_type(fp) == "Subject"]
         if len(subjects) <= 0:
             FreeCAD.Console.PrintMessage(f"Subjects are not found.\n")
             return
 
         # 構成部品をJsonファイル化する
-        ls = FreeCAD.ActiveDocument.getObject("LightSource")
-        det = FreeCAD.ActiveDocument.getObject("Detector")
-        subjectsStore = SubjectStore(subjects)
-        componentsStore = ComponentsStore(subjectsStore, ls, det)
+        optical_systems = self.get_optical_systems()
+        if not optical_systems:
+            FreeCAD.Console.PrintMessage(f"Pairs of LightSource and Detector are not found.\n")
+            return
+        subjectsStore = SubjectStore(subjects, parallel=True)
+        componentsStore = ComponentsStore(subjectsStore, optical_systems)
         json_path = componentsStore.SaveAsJson(folder_path)
 
         # X線画像出力部にJsonパスを渡す
         if self.can_compute_xray:
-            import libs.gvxrEngine as gvxrEx
+            import libs.renderClient as renderClient
             import matplotlib.pyplot as plt
             import numpy as np
 
-            try:
-                gvxrComponents = gvxrEx.Composition.CreateFromJson(json_path)
-                xray_img = self.engine.Shot(gvxrComponents)
+            # gvxrはFreeCADではなくサーバーを起動するPythonから読み込めるかを確認する
+            # ワークベンチの読み込みを待たせないよう、初めて撮影するときに確認する
+            if not renderClient.is_engine_available():
+                FreeCAD.Console.PrintMessage("gvxrPython3 is not found. Install gvxr into the Python bundled with FreeCAD.\n")
+                return
 
-                xray_fpath = os.path.join(folder_path, "xrayimage.tiff")
-                plt.imsave(xray_fpath, xray_img, cmap='gray')
-                FreeCAD.Console.PrintMessage(f"Save xray image: {xray_fpath}.\n")
+            try:
+                # シーンの読み込みは1回で、LightSourceとDetectorの組ごとに撮影する
+                xray_imgs = self.client.ShotViews(json_path)
+                with open(json_path, 'rt', encoding='utf-8') as f:
+                    views = {view_d['Name']: view_d for view_d in json.load(f)['Views']}
 
             except Exception as ex:
                 FreeCAD.Console.PrintMessage(ex)
+                return
+
+            for name, xray_img in xray_imgs.items():
+                suffix = "" if len(xray_imgs) == 1 else f"_{name}"
+                try:
+                    # tiffは最新画像のプレビューとして、ストアへの追記より先に上書きする
+                    xray_fpath = os.path.join(folder_path, f"xrayimage{suffix}.tiff")
+                    plt.imsave(xray_fpath, xray_img, cmap='gray')
+                    FreeCAD.Console.PrintMessage(f"Save xray image: {xray_fpath}.\n")
+
+                    # 撮影のたびに組ごとのストアへ画像と撮影条件を追記する
+                    store = self.open_projection_store(folder_path, f"xrayimages{suffix}", xray_img)
+                    parameters = dict(views[name], Time=datetime.datetime.now().isoformat())
+                    index = store.Append(xray_img, parameters)
+                    FreeCAD.Console.PrintMessage(f"Append xray image #{index} to {store.path}.\n")
+
+                except Exception as ex:
+                    FreeCAD.Console.PrintMessage(f"{ex}\n")
 
     def IsActive(self):
         '''Here you can define if the command must be active or not (greyed) if certain conditions
@@ -188,10 +237,9 @@ class AcquireXRayImageCommand():
         if FreeCAD.ActiveDocument is None:
             return False
         
-        if FreeCAD.ActiveDocument.getObject("LightSource") is None:
-            return False
-
-        if FreeCAD.ActiveDocument.getObject("Detector") is None:
+        # GUIの更新のたびに呼ばれるので、組の一覧は作らずDetectorの有無だけを見る
+        r = FreeCAD.ActiveDocument.findObjects("Part::FeaturePython")
+        if not any(_get_proxy_type(fp) == "Detector" for fp in r):
             return False
         
         return True
@@ -203,6 +251,31 @@ class AcquireXRayImageCommand():
                 'MenuText': 'AcquireXRayImage',
                 'ToolTip' : 'Acquire an x-ray image' }               
     
+    def get_optical_systems(self):
+        # Detectorごとに対になるLightSourceを探す。リンクを持たない古いDetectorは"LightSource"と組にする
+        r = FreeCAD.ActiveDocument.findObjects("Part::FeaturePython")
+        detectors = [fp for fp in r if _get_proxy_type(fp) == "Detector"]
+        optical_systems = []
+        for det in detectors:
+            if hasattr(det, "LightSource"):
+                ls = det.LightSource
+            else:
+                ls = FreeCAD.ActiveDocument.getObject("LightSource")
+            if ls is None:
+                FreeCAD.Console.PrintMessage(f"Detector {det.Label} has no LightSource. Skipped.\n")
+                continue
+            optical_systems.append((ls, det))
+        return optical_systems
+
+    def open_projection_store(self, folder_path, name, xray_img):
+        # Detectorの画素数を変えた場合など既存のストアと画像の形状が合わない場合は、形状を名前に含めた別のストアに追記する
+        store_path = os.path.join(folder_path, f"{name}.xrs")
+        try:
+            return ProjectionStore.Create(store_path, xray_img.shape, xray_img.dtype)
+        except ValueError:
+            store_path = os.path.join(folder_path, f"{name}_{xray_img.shape[1]}x{xray_img.shape[0]}.xrs")
+            return ProjectionStore.Create(store_path, xray_img.shape, xray_img.dtype)
+
     def get_folder_path(self):
         dialog = QtGui.QFileDialog()
         dialog.setFileMode(QtGui.QFileDialog.Directory)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 
 def get_module_path():
     ''' Returns the current module path.
@@ -8,4 +9,20 @@ def get_module_path():
     the module is installed in the app's module directory or the user's app data folder.
     (The second overrides the first.)
     '''
-    return os.path.dirname(__file__)
\ No newline at end of file
+    return os.path.dirname(__file__)
+
+def get_python_executable():
+    ''' Returns the Python interpreter used to start helper processes, or None if it is not found.
+    Inside FreeCAD, sys.executable points to the FreeCAD binary, so the interpreter
+    bundled next to it is used instead. On Windows, pythonw.exe is preferred so that
+    helper processes do not open console windows.
+    '''
+    exe = sys.executable
+    if os.name != "nt" and os.path.basename(exe).lower().startswith("python"):
+        return exe
+    names = ["pythonw.exe", "python.exe"] if os.name == "nt" else ["python3", "python"]
+    for name in names:
+        candidate = os.path.join(os.path.dirname(exe), name)
+        if os.path.isfile(candidate):
+            return candidate
+    return None
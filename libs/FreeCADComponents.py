@@ -4,13 +4,18 @@ import Part
 import Mesh
 import os
 import json
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
+from XRayImagingWorkbench import get_python_executable
+from libs.beamGeometry import beam_frustum, box_corners, is_outside_frustum
 
 class ComponentsStore():
-    def __init__(self, subjectsStore, lightSource, detector) -> None:
+    def __init__(self, subjectsStore, opticalSystems) -> None:
+        # opticalSystemsは(LightSource, Detector)の組のリスト。Detectorのラベルを組の名前とする
         self.subjectsStore = subjectsStore
-        self.lightSource = lightSource
-        self.detector = detector
+        self.opticalSystems = opticalSystems
 
     def SaveAsJson(self, dirpath):
         d = {}
@@ -18,17 +23,41 @@ class ComponentsStore():
         # condition
         d['WindowSize'] = [512, 512]
 
-        # LightSource
-        d['Source'] = self._get_lightsource_dict(self.lightSource)
+        # LightSourceとDetectorの組
+        d['Views'] = []
+        for lightSource, detector in self.opticalSystems:
+            view_d = {}
+            view_d['Name'] = detector.Label
+            view_d['Source'] = self._get_lightsource_dict(lightSource)
+            view_d['Detector'] = self._get_detector_dict(detector)
+            d['Views'].append(view_d)
 
-        # Detector
-        d['Detector'] = self._get_detector_dict(self.detector)
+        # 1組だけを読むツール向けに先頭の組も残す
+        d['Source'] = d['Views'][0]['Source']
+        d['Detector'] = d['Views'][0]['Detector']
 
         # Subjects
+        # どの組のビームにも入らないSubjectはSTLを出力せずに除外する
+        # 変換と境界箱はSubjectごとに1回だけ求め、除外の判定とJsonの両方に使う
+        frustums = [self._get_frustum(view_d) for view_d in d['Views']]
+        subjects = []
+        frames = {}
+        d['Culled'] = []
+        for subject in self.subjectsStore.subjects:
+            transform_d = self._get_transform_dict(subject)
+            bbox = self._get_bounding_box(subject)
+            if bbox is not None and self._is_outside_beams(bbox, transform_d, frustums):
+                d['Culled'].append(subject.Label)
+            else:
+                subjects.append(subject)
+                frames[subject.Name] = (transform_d, bbox)
+        if len(d['Culled']) > 0:
+            FreeCAD.Console.PrintMessage(f"Culled {len(d['Culled'])} subject(s) outside the beam: {', '.join(d['Culled'])}.\n")
+
         d['Polygons'] = []
-        filepath_d = self.subjectsStore.SaveAsStl(dirpath)
+        filepath_d = self.subjectsStore.SaveAsStl(dirpath, subjects)
         for fpath, subject in filepath_d.items():
-            subject_d = self._get_subject_dict(fpath, subject)
+            subject_d = self._get_subject_dict(fpath, subject, *frames[subject.Name])
             d['Polygons'].append(subject_d)
 
         json_fpath = os.path.join(dirpath, "converted.json")
@@ -36,7 +65,7 @@ class ComponentsStore():
             json.dump(d, f)
         return json_fpath
 
-    def _get_subject_dict(self, fpath, subject):
+    def _get_subject_dict(self, fpath, subject, transform_d, bbox):
         d = {}
         d['SampleType'] = 'Polygon'
         d['Label'] = subject.Label
@@ -47,14 +76,60 @@ class ComponentsStore():
         d['Material']['Element'] = subject.Element
         d['Material']['Density'] = subject.Density
         d['Type'] = 'inner'
-        pos = subject.LinkedObject.Shape.CenterOfGravity
+        d.update(transform_d)
+        if bbox is not None:
+            d['BoundingBox'] = bbox
+        return d
+
+    def _get_transform_dict(self, subject):
+        # メッシュはローカル座標で出力しているので、グローバルなPlacementをそのまま渡す
+        d = {}
+        placement = self._get_global_placement(subject)
+        pos = placement.Base
         d['Translate'] = [pos.x, pos.y, pos.z]
-        axis = subject.LinkedObject.Placement.Rotation.Axis
+        axis = placement.Rotation.Axis
         d['RotateAxis'] = [axis.x, axis.y, axis.z]
-        angle_rad = subject.LinkedObject.Placement.Rotation.Angle
-        d['RotateAngle'] = 0.# np.rad2deg(angle_rad)
+        d['RotateAngle'] = np.rad2deg(placement.Rotation.Angle)
         return d
 
+    def _get_frustum(self, view_d):
+        source_d = view_d['Source']
+        detector_d = view_d['Detector']
+        return beam_frustum(source_d['Position'], detector_d['Position'], detector_d['UpVector'], detector_d['NumberOfPixels'][0], detector_d['NumberOfPixels'][1], detector_d['Spacing'][0], detector_d['Spacing'][1])
+
+    def _get_bounding_box(self, subject):
+        try:
+            return self.subjectsStore.GetLocalBoundingBox(subject)
+        except Exception:
+            # 境界箱が求められない形状は除外しない
+            return None
+
+    def _is_outside_beams(self, bbox, transform_d, frustums):
+        corners = box_corners(bbox, transform_d['Translate'], transform_d['RotateAxis'], transform_d['RotateAngle'])
+        return all(is_outside_frustum(corners, planes) for planes in frustums)
+
+    def _get_global_placement(self, subject):
+        # App::Linkを経由して選択したSubject(Assembly4など)は、ルートからの経路上のPlacementをすべて合成する
+        # Linkの配置(LinkTransformの有無を含む)はgetSubObjectが解決する
+        root = getattr(subject, "PlacementRoot", None)
+        if root is not None:
+            found = root.getSubObject(subject.PlacementSubName, retType=1, matrix=FreeCAD.Matrix())
+            if not found:
+                raise ValueError(f"{subject.PlacementSubName} is not found in {root.Label}.")
+            return FreeCAD.Placement(found[1])
+
+        # それ以外は親のPart(GeoFeatureGroup)のPlacementを合成する
+        obj = subject.LinkedObject
+        if hasattr(obj, "getGlobalPlacement"):
+            return obj.getGlobalPlacement()
+
+        placement = obj.Placement
+        parent = obj.getParentGeoFeatureGroup()
+        while parent is not None:
+            placement = parent.Placement.multiply(placement)
+            parent = parent.getParentGeoFeatureGroup()
+        return placement
+
     def _get_lightsource_dict(self, lightsource):
         d = {}
         pos = lightsource.Shape.CenterOfGravity
@@ -65,6 +140,8 @@ class ComponentsStore():
         d["Beam"]["Energy"] = lightsource.Energy
         d["Beam"]["Unit"] = lightsource.EnergyUnit
         d["Beam"]["PhotonCount"] = lightsource.aNumberOfPhotons
+        # 古いドキュメントのLightSourceには焦点サイズのプロパティが無い
+        d["FocalSpot"] = {"Shape": "Gaussian", "FWHM": getattr(lightsource, "FocalSpotSize", 0.0)}
         return d
 
     def _get_detector_dict(self, detector):
@@ -81,43 +158,134 @@ class ComponentsStore():
         else:
             d["NumberOfPixels"] = [detector.Width, detector.Height]
             d["Spacing"] = [detector.ColumnPixelSpacing, detector.RowPixelSpacing]
+        d["PSF"] = {"Shape": "Gaussian", "FWHM": getattr(detector, "PsfFwhm", 0.0)}
         return d
 
 
+def _export_brep_as_stl(brep, filepath, tolerance):
+    # ワーカープロセスで実行される。B-rep文字列から形状を復元してSTLに書き出す
+    shape = Part.Shape()
+    shape.importBrepFromString(brep)
+    mesh = Mesh.Mesh()
+    mesh.addFacets(shape.tessellate(tolerance))
+    mesh.write(filepath)
+    return filepath
+
 class SubjectStore():
-    def __init__(self, subjects) -> None:
+    def __init__(self, subjects, parallel=False, max_workers=None, tolerance=0.1, min_parallel_subjects=4) -> None:
         self.subjects = subjects
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.tolerance = tolerance
+        # ワーカーの起動(FreeCADのモジュール読み込みを含む)に見合わない少数のSubjectは逐次出力する
+        self.min_parallel_subjects = min_parallel_subjects
+
+    def SaveAsStl(self, dirpath, subjects=None):
+        # PartごとにSTLに変換してファイル出力し、Subjectとファイルパスの辞書を返す
+        # ファイル名はSubjectの並び順で決めるので、並列出力でも同じ名前になる
+        # subjectsを指定した場合はその一部だけを出力する
+        if subjects is None:
+            subjects = self.subjects
+        stl_fpaths = [os.path.join(dirpath, f'{i:02}.stl') for i in range(len(subjects))]
+        if self.parallel and len(subjects) >= max(self.min_parallel_subjects, 2):
+            exported = self._save_as_stl_parallel(subjects, stl_fpaths)
+        else:
+            exported = self._save_as_stl_serial(subjects, stl_fpaths)
 
-    def SaveAsStl(self, dirpath):
-        # PartごとにSTLに変換してファイル出力し、Subjectとファイスパスの辞書を返す
         filepath_d = {}
-        file_index = 0
-        for subject in self.subjects:
-            stl_fname = f'{file_index:02}.stl'
-            stl_fpath = os.path.join(dirpath, stl_fname)
+        for subject, stl_fpath in zip(subjects, stl_fpaths):
+            if stl_fpath in exported:
+                filepath_d[stl_fpath] = subject
+        return filepath_d
+
+    def _save_as_stl_serial(self, subjects, stl_fpaths):
+        exported = set()
+        for subject, stl_fpath in zip(subjects, stl_fpaths):
             try:
                 self.export_as_stl(subject.LinkedObject, stl_fpath)
-                filepath_d[stl_fpath] = subject
-                file_index += 1
+                exported.add(stl_fpath)
             except Exception as ex:
                 FreeCAD.Console.PrintMessage(f"{ex}\n")
-        return filepath_d
+        return exported
+
+    def _save_as_stl_parallel(self, subjects, stl_fpaths):
+        # 形状はメインプロセスでB-rep文字列にスナップショットし、テッセレーションと書き出しはワーカーで行う
+        python = get_python_executable()
+        if python is None:
+            FreeCAD.Console.PrintMessage(f"Python interpreter for workers is not found. Fall back to serial export.\n")
+            return self._save_as_stl_serial(subjects, stl_fpaths)
+
+        exported = set()
+        retry = []
+        pending = list(zip(subjects, stl_fpaths))
+        max_workers = min(self.max_workers or os.cpu_count() or 1, len(pending))
+        ctx = multiprocessing.get_context("spawn")
+        ctx.set_executable(python)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as executor:
+            futures = {}
+            for i, (subject, stl_fpath) in enumerate(pending):
+                try:
+                    brep = self._get_local_shape(subject.LinkedObject).exportBrepToString()
+                except Exception as ex:
+                    FreeCAD.Console.PrintMessage(f"{ex}\n")
+                    continue
+                try:
+                    future = executor.submit(_export_brep_as_stl, brep, stl_fpath, self.tolerance)
+                except (BrokenProcessPool, OSError, RuntimeError):
+                    # ワーカーが起動できずプールが壊れた場合は、このSubjectと未投入のSubjectをすべて逐次出力に回す
+                    retry.extend(pending[i:])
+                    break
+                futures[future] = (subject, stl_fpath)
+
+            for future in concurrent.futures.as_completed(futures):
+                subject, stl_fpath = futures[future]
+                try:
+                    future.result()
+                    exported.add(stl_fpath)
+                    FreeCAD.Console.PrintMessage(f"Convertion successful. Save to {stl_fpath}.\n")
+                except BrokenProcessPool:
+                    retry.append((subject, stl_fpath))
+                except Exception as ex:
+                    FreeCAD.Console.PrintMessage(f"{ex}\n")
+
+        # ワーカーが起動できなかった場合は逐次出力に切り替える
+        if len(retry) > 0:
+            FreeCAD.Console.PrintMessage(f"Worker pool is unavailable. Fall back to serial export.\n")
+            subjects, fpaths = zip(*retry)
+            exported |= self._save_as_stl_serial(subjects, fpaths)
+        return exported
+
+    def GetLocalBoundingBox(self, subject):
+        # ローカル座標での境界箱を[xmin, ymin, zmin, xmax, ymax, zmax]で返す
+        bb = self._get_local_shape(subject.LinkedObject).BoundBox
+        return [bb.XMin, bb.YMin, bb.ZMin, bb.XMax, bb.YMax, bb.ZMax]
+
+    def _get_local_shape(self, part):
+        # Placementは変換行列として別途出力するので、メッシュはローカル座標で書き出す
+        # part.Shapeは変更できないので、Placementを書き換えられるようにcopy(False)で複製する
+        # copy(False)は幾何形状を共有したままにするので、形状データの複製は発生しない
+        shape = part.Shape.copy(False)
+        shape.Placement = FreeCAD.Placement()
+        return shape
 
     def export_as_stl(self, part, filepath):
         try:
             mesh = Mesh.Mesh()
-            mesh.addFacets(part.Shape.tessellate(0.1))
+            mesh.addFacets(self._get_local_shape(part).tessellate(self.tolerance))
             mesh.write(filepath)
             FreeCAD.Console.PrintMessage(f"Convertion successful. Save to {filepath}.\n")
         except Exception as ex:
             raise ex
 
 class Subject():
-    def __init__(self, fp, base) -> None:
+    def __init__(self, fp, base, placementRoot=None, placementSubName="") -> None:
         self.Type = "Subject"
         fp.Proxy = self
 
-        fp.addProperty("App::PropertyLink", "LinkedObject", "Custom", "FreeCAD object to be subject").LinkedObject = base
+        # Linkで配置された部品は別ドキュメントにある場合があるのでXLinkで参照する
+        fp.addProperty("App::PropertyXLink", "LinkedObject", "Custom", "FreeCAD object to be subject").LinkedObject = base
+        fp.addProperty("App::PropertyLink", "PlacementRoot", "Custom", "the root object of the path to LinkedObject. Set only if the path passes through an App::Link.").PlacementRoot = placementRoot
+        fp.addProperty("App::PropertyString", "PlacementSubName", "Custom", "the path from PlacementRoot to LinkedObject.").PlacementSubName = placementSubName
         # fp.addProperty("App::PropertyString", "UniqueLabel", "Custom", "Label must be unique").UniqueLabel = label
         fp.addProperty("App::PropertyEnumeration", "ElementType", "Custom", "ElementType").ElementType = ["Element", "Compound", "Mixture"]
         fp.addProperty("App::PropertyString", "Element", "Custom", "Element. This property is effective only if the ElementType is Element.").Element = "Fe" # TODO: Selectable from ["Fe", "C",,,and more]
@@ -131,6 +299,8 @@ class Subject():
         fp.setPropertyStatus("Label", "ReadOnly")
         # fp.setPropertyStatus("UniqueLabel", "Hidden") # set "-Hidden" to visible
         fp.setPropertyStatus("LinkedObject", "ReadOnly")
+        fp.setPropertyStatus("PlacementRoot", "ReadOnly")
+        fp.setPropertyStatus("PlacementSubName", "ReadOnly")
         # if hasattr(obj, "CustomProperty") == False:
         #     obj.addProperty("App::PropertyString", "CustomProperty", "MyObject", "A custom property.")
         # pass
@@ -154,6 +324,7 @@ class LightSource():
         fp.addProperty("App::PropertyFloat", "Energy", "Custom", "the incident photon energy").Energy = 1.0
         fp.addProperty("App::PropertyEnumeration", "EnergyUnit", "Custom", "the unit of energy corresponding to anEnergy.").EnergyUnit = ["eV", "keV", "MeV"]
         fp.addProperty("App::PropertyInteger", "aNumberOfPhotons", "Custom", "the number of incident photons.").aNumberOfPhotons = 1000
+        fp.addProperty("App::PropertyFloat", "FocalSpotSize", "Custom", "the focal spot size (FWHM[mm]). 0 means an ideal point source.").FocalSpotSize = 0.0
 
         fp.EnergyUnit = "keV"
         fp.setPropertyStatus("Label", "ReadOnly")
@@ -166,7 +337,7 @@ class LightSource():
         obj.Shape = sphere
 
 class Detector():
-    def __init__(self, fp) -> None:
+    def __init__(self, fp, lightSource=None) -> None:
         self.Type = "Detector"
         fp.Proxy = self
 
@@ -177,6 +348,8 @@ class Detector():
         fp.addProperty("App::PropertyEnumeration", "UpVectorEdge", "Custom", "UpVectorEdge").UpVectorEdge = ["0", "1"]
         fp.addProperty("App::PropertyEnumeration", "UpVectorDirection", "Custom", "UpVectorDirection").UpVectorDirection = ["Positive", "Negative"]
         fp.addProperty("App::PropertyVector", "UpVector", "Custom", "the orientation of the X-ray detector.").UpVector = FreeCAD.Vector(0, 0, 1)
+        fp.addProperty("App::PropertyLink", "LightSource", "Custom", "the light source paired with this detector.").LightSource = lightSource
+        fp.addProperty("App::PropertyFloat", "PsfFwhm", "Custom", "the FWHM[mm] of the detector point spread function. 0 means no blur.").PsfFwhm = 0.0
         # fp.addProperty("App::PropertyLink", "LinkedObject", "Custom", "FreeCAD object to be subject").LinkedObject = base
 
         # fp.EnergyUnit = "keV"
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import numpy as np
+from typing import List, Tuple
+
+def detector_basis(sourcePosition, detectorPosition, upVector):
+    '''ビーム方向ew、検出器の上方向ev、列方向eu = ev × ewの正規直交基底を返す'''
+    ew = normalize(np.asarray(detectorPosition, dtype=np.float64) - np.asarray(sourcePosition, dtype=np.float64))
+    up = np.asarray(upVector, dtype=np.float64)
+    ev = normalize(up - np.dot(up, ew) * ew)
+    eu = np.cross(ev, ew)
+    return ew, ev, eu
+
+def detector_corners(sourcePosition, detectorPosition, upVector, width, height, colSpacing, rowSpacing):
+    '''検出器の四隅を周回順に(4, 3)の配列で返す'''
+    ew, ev, eu = detector_basis(sourcePosition, detectorPosition, upVector)
+    center = np.asarray(detectorPosition, dtype=np.float64)
+    hu = eu * width * colSpacing / 2
+    hv = ev * height * rowSpacing / 2
+    return np.array([center - hu - hv, center + hu - hv, center + hu + hv, center - hu + hv])
+
+def beam_frustum(sourcePosition, detectorPosition, upVector, width, height, colSpacing, rowSpacing) -> List[Tuple[np.ndarray, float]]:
+    '''線源を頂点、検出器を底面とする四角錐を平面(法線n, d)のリストで返す
+
+    n・x + d >= 0 が錐台の内側になるように法線の向きを揃える。側面4枚に加えて、
+    線源の後ろ側と検出器の裏側を除く2枚を含む。
+    '''
+    source = np.asarray(sourcePosition, dtype=np.float64)
+    center = np.asarray(detectorPosition, dtype=np.float64)
+    corners = detector_corners(source, center, upVector, width, height, colSpacing, rowSpacing)
+
+    planes = []
+    for i in range(4):
+        n = np.cross(corners[i] - source, corners[(i + 1) % 4] - source)
+        if np.dot(n, center - source) < 0:
+            n = -n
+        n = normalize(n)
+        planes.append((n, -float(np.dot(n, source))))
+
+    ew = normalize(center - source)
+    planes.append((ew, -float(np.dot(ew, source))))
+    planes.append((-ew, float(np.dot(ew, center))))
+    return planes
+
+def box_corners(boundingBox, translate=(0, 0, 0), rotateAxis=(0, 0, 1), rotateAngle=0):
+    '''ローカル座標の境界箱[xmin, ymin, zmin, xmax, ymax, zmax]を回転・平行移動した8頂点を返す'''
+    bmin = np.asarray(boundingBox[:3], dtype=np.float64)
+    bmax = np.asarray(boundingBox[3:], dtype=np.float64)
+    corners = np.array([[x, y, z] for x in (bmin[0], bmax[0]) for y in (bmin[1], bmax[1]) for z in (bmin[2], bmax[2])])
+    axis = np.asarray(rotateAxis, dtype=np.float64)
+    if np.linalg.norm(axis) > 0 and rotateAngle != 0:
+        corners = corners @ rotation_matrix(normalize(axis), np.deg2rad(rotateAngle)).T
+    return corners + np.asarray(translate, dtype=np.float64)
+
+def is_outside_frustum(corners, planes) -> bool:
+    '''いずれかの平面に対して全頂点が外側にあれば錐台と交わらない(保守的な判定)'''
+    for n, d in planes:
+        if np.all(corners @ n + d < 0):
+            return True
+    return False
+
+def normalize(vec):
+    norm = np.linalg.norm(vec)
+    if norm == 0:
+        raise ValueError("Zero-length vector.")
+    return vec / norm
+
+def rotation_matrix(axis, angle):
+    # ロドリゲスの回転公式
+    k = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    return np.eye(3) + np.sin(angle) * k + (1 - np.cos(angle)) * (k @ k)
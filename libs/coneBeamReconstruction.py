@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+import numpy as np
+from typing import Tuple
+import concurrent.futures
+import os
+from libs.beamGeometry import detector_basis, normalize, rotation_matrix
+
+class ConeBeamGeometry:
+    '''円軌道コーンビームCTの幾何
+
+    試料を回転中心・回転軸まわりにangles[deg]だけ回転させて撮影した投影を想定する。
+    再構成では逆に線源と検出器を-anglesだけ回転させて扱う。anglesは1周(360°)を
+    過不足なく覆う必要がある(ショートスキャンのParker重みには対応しない)。
+    投影画像の行は検出器のUpVector方向(行0が上端)、列はUpVector×ビーム方向に並ぶ。
+    '''
+    def __init__(self, sourcePosition, detectorPosition, upVector, width, height, colSpacing, rowSpacing, angles, rotationCenter=None, rotationAxis=None) -> None:
+        self.sourcePosition = np.asarray(sourcePosition, dtype=np.float64)
+        self.detectorPosition = np.asarray(detectorPosition, dtype=np.float64)
+        self.width = int(width)
+        self.height = int(height)
+        self.colSpacing = float(colSpacing)
+        self.rowSpacing = float(rowSpacing)
+        self.angles = np.asarray(angles, dtype=np.float64)
+        self._check_full_rotation()
+        self.rotationCenter = np.zeros(3) if rotationCenter is None else np.asarray(rotationCenter, dtype=np.float64)
+
+        self.ew, self.ev, self.eu = detector_basis(self.sourcePosition, self.detectorPosition, upVector)
+        self.rotationAxis = self.ev if rotationAxis is None else normalize(np.asarray(rotationAxis, dtype=np.float64))
+
+        # 線源-回転中心距離(SOD)と線源-検出器距離(SDD)
+        self.sod = float(np.dot(self.rotationCenter - self.sourcePosition, self.ew))
+        self.sdd = float(np.dot(self.detectorPosition - self.sourcePosition, self.ew))
+        if self.sod <= 0 or self.sdd <= self.sod:
+            raise ValueError("The rotation center must lie between the source and the detector.")
+
+    @staticmethod
+    def CreateFromComposition(lightSource, detector, angles, rotationCenter=None, rotationAxis=None):
+        return ConeBeamGeometry(lightSource.position, detector.position, detector.upVector, detector.width, detector.height, detector.colSpacing, detector.rowSpacing, angles, rotationCenter, rotationAxis)
+
+    def GetView(self, index):
+        '''index番目の投影における線源位置と検出器の基底(ew, ev, eu)を返す'''
+        rot = rotation_matrix(self.rotationAxis, -np.deg2rad(self.angles[index]))
+        source = self.rotationCenter + rot @ (self.sourcePosition - self.rotationCenter)
+        return source, rot @ self.ew, rot @ self.ev, rot @ self.eu
+
+    def GetAngularWeights(self):
+        # 各投影が受け持つ角度幅[rad]
+        return np.abs(np.gradient(np.deg2rad(self.angles)))
+
+    def _check_full_rotation(self):
+        # FDKの0.5 * dβの重みは1周分の投影を前提とするので、欠けや重複があると減弱係数がずれる
+        if len(self.angles) < 2:
+            raise ValueError("At least two projection angles are required.")
+        wrapped = np.sort(np.mod(self.angles, 360))
+        gaps = np.diff(np.concatenate([wrapped, wrapped[:1] + 360]))
+        weights = np.rad2deg(self.GetAngularWeights())
+        if gaps.max() > 2 * np.median(gaps) or abs(weights.sum() - 360) > weights.max():
+            raise ValueError("Projection angles must cover exactly one full rotation (360 deg). Short scans are not supported.")
+
+
+class FDKReconstructor:
+    '''FDK法(フィルタ補正逆投影)によるコーンビーム再構成
+
+    投影は線積分値(-log(I/I0))で(投影数, 行, 列)の配列として渡す。
+    逆投影はZ方向のスラブ単位でスレッドプールに分配し、出力先を指定した場合は
+    .npy形式のメモリマップに書き出すので、ボリューム全体をメモリに載せる必要はない。
+    '''
+    filters = ["ram-lak", "shepp-logan", "cosine", "hann"]
+
+    def __init__(self, geometry:ConeBeamGeometry, volumeShape:Tuple[int, int, int], voxelSize, filterName="ram-lak", chunkSize=8, nWorkers=None) -> None:
+        if filterName not in self.filters:
+            raise ValueError(f"Unknown filter: {filterName}. Choose from {self.filters}.")
+        self.geometry = geometry
+        self.volumeShape = tuple(int(n) for n in volumeShape)# (nz, ny, nx)
+        self.voxelSize = np.broadcast_to(np.asarray(voxelSize, dtype=np.float64), (3,))# (sx, sy, sz)
+        self.filterName = filterName
+        self.chunkSize = chunkSize
+        self.nWorkers = nWorkers if nWorkers is not None else os.cpu_count()
+
+    def Reconstruct(self, projections, outPath=None):
+        '''投影を再構成してボリューム(nz, ny, nx)を返す。outPathを指定した場合はメモリマップを返す'''
+        geometry = self.geometry
+        if projections.shape != (len(geometry.angles), geometry.height, geometry.width):
+            raise ValueError(f"Projections must have the shape {(len(geometry.angles), geometry.height, geometry.width)}.")
+
+        filtered = self._filter(projections)
+
+        if outPath is None:
+            volume = np.zeros(self.volumeShape, dtype=np.float32)
+        else:
+            volume = np.lib.format.open_memmap(outPath, mode="w+", dtype=np.float32, shape=self.volumeShape)
+
+        nz = self.volumeShape[0]
+        slabs = [(z0, min(z0 + self.chunkSize, nz)) for z0 in range(0, nz, self.chunkSize)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nWorkers) as executor:
+            futures = [executor.submit(self._backproject_slab, filtered, volume, z0, z1) for z0, z1 in slabs]
+            for future in futures:
+                future.result()
+
+        if isinstance(volume, np.memmap):
+            volume.flush()
+        return volume
+
+    def _filter(self, projections):
+        # コサイン重み付けと行方向のランプフィルタ
+        geometry = self.geometry
+        u, v = self._detector_coordinates()
+        weight = (geometry.sdd / np.sqrt(geometry.sdd ** 2 + u[np.newaxis, :] ** 2 + v[:, np.newaxis] ** 2)).astype(np.float32)
+        ramp = self._ramp_filter(geometry.width, geometry.colSpacing * geometry.sod / geometry.sdd)
+        n_fft = (len(ramp) - 1) * 2
+
+        filtered = np.empty(projections.shape, dtype=np.float32)
+        for p0 in range(0, projections.shape[0], self.chunkSize):
+            p1 = min(p0 + self.chunkSize, projections.shape[0])
+            chunk = np.asarray(projections[p0:p1], dtype=np.float32) * weight
+            spectrum = np.fft.rfft(chunk, n=n_fft, axis=-1)
+            filtered[p0:p1] = np.fft.irfft(spectrum * ramp, n=n_fft, axis=-1)[..., :geometry.width]
+        return filtered
+
+    def _ramp_filter(self, n, spacing):
+        # 空間領域で離散化したRam-Lakカーネルから周波数応答を作る(直流成分のずれを防ぐため)
+        n_fft = int(2 ** np.ceil(np.log2(2 * n)))
+        k = np.concatenate([np.arange(0, n_fft // 2 + 1), np.arange(-(n_fft // 2) + 1, 0)])
+        h = np.zeros(n_fft)
+        h[0] = 1 / (4 * spacing ** 2)
+        odd = k % 2 == 1
+        h[odd] = -1 / (np.pi * k[odd] * spacing) ** 2
+        ramp = np.real(np.fft.rfft(h)) * spacing
+
+        omega = np.linspace(0, np.pi, len(ramp))
+        if self.filterName == "shepp-logan":
+            ramp[1:] *= np.sin(omega[1:] / 2) / (omega[1:] / 2)
+        elif self.filterName == "cosine":
+            ramp *= np.cos(omega / 2)
+        elif self.filterName == "hann":
+            ramp *= (1 + np.cos(omega)) / 2
+        return ramp.astype(np.complex64)
+
+    def _detector_coordinates(self):
+        geometry = self.geometry
+        u = (np.arange(geometry.width) - (geometry.width - 1) / 2) * geometry.colSpacing
+        v = ((geometry.height - 1) / 2 - np.arange(geometry.height)) * geometry.rowSpacing
+        return u, v
+
+    def _voxel_axes(self, z0, z1):
+        # ボリュームは回転中心を中心としたワールド座標軸に沿って並ぶ
+        nz, ny, nx = self.volumeShape
+        sx, sy, sz = self.voxelSize
+        x = (np.arange(nx) - (nx - 1) / 2) * sx
+        y = (np.arange(ny) - (ny - 1) / 2) * sy
+        z = (np.arange(z0, z1) - (nz - 1) / 2) * sz
+        return x, y, z
+
+    def _backproject_slab(self, filtered, volume, z0, z1):
+        geometry = self.geometry
+        x, y, z = self._voxel_axes(z0, z1)
+        center = geometry.rotationCenter
+        dbeta = geometry.GetAngularWeights()
+        width, height = geometry.width, geometry.height
+
+        slab = np.zeros((z1 - z0, len(y), len(x)), dtype=np.float32)
+        for i in range(filtered.shape[0]):
+            source, ew, ev, eu = geometry.GetView(i)
+
+            # (x - source)・e を軸ごとの和に分解して計算量を抑える
+            def project(e):
+                offset = np.dot(center - source, e)
+                return (z[:, np.newaxis, np.newaxis] * e[2] + y[np.newaxis, :, np.newaxis] * e[1] + x[np.newaxis, np.newaxis, :] * e[0] + offset).astype(np.float32)
+
+            w = project(ew)
+            scale = np.float32(geometry.sdd) / w
+            col = project(eu) * scale / np.float32(geometry.colSpacing) + np.float32((width - 1) / 2)
+            row = np.float32((height - 1) / 2) - project(ev) * scale / np.float32(geometry.rowSpacing)
+            weight = np.float32(0.5 * dbeta[i] * geometry.sod ** 2) / (w * w)
+
+            slab += weight * _bilinear(filtered[i], row, col)
+
+        volume[z0:z1] = slab
+
+def _bilinear(image, row, col):
+    # 検出器外は0として双線形補間する
+    height, width = image.shape
+    inside = (row >= 0) & (row <= height - 1) & (col >= 0) & (col <= width - 1)
+    row = np.clip(row, 0, height - 1)
+    col = np.clip(col, 0, width - 1)
+    r0 = np.minimum(row.astype(np.int32), max(height - 2, 0))
+    c0 = np.minimum(col.astype(np.int32), max(width - 2, 0))
+    tr = row - r0
+    tc = col - c0
+    r1 = np.minimum(r0 + 1, height - 1)
+    c1 = np.minimum(c0 + 1, width - 1)
+
+    top = image[r0, c0] * (1 - tc) + image[r0, c1] * tc
+    bottom = image[r1, c0] * (1 - tc) + image[r1, c1] * tc
+    return np.where(inside, top * (1 - tr) + bottom * tr, 0).astype(np.float32)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import numpy as np
+from typing import Dict, Iterable, Iterator
+
+class FlatFieldCorrection:
+    '''フラット・ダーク補正(I - D) / (F - D)と-log変換で投影を線積分値に変換する
+
+    投影の束はchunkSize枚ずつ処理するので、np.memmapのような全体をメモリに載せない
+    配列でもそのまま扱える。浮動小数点の配列はその場で書き換える。
+    '''
+    def __init__(self, flat, dark=None, log=True, chunkSize=16, minValue=1e-6) -> None:
+        flat = np.asarray(flat, dtype=np.float32)
+        self.dark = np.zeros_like(flat) if dark is None else np.broadcast_to(np.asarray(dark, dtype=np.float32), flat.shape).copy()
+        # 割り算を毎回しないように逆数を保持する。感度の無い画素は0にする
+        gain = flat - self.dark
+        self.scale = np.where(gain > 0, 1 / np.where(gain > 0, gain, 1), 0).astype(np.float32)
+        self.log = log
+        self.chunkSize = chunkSize
+        self.minValue = np.float32(minValue)
+
+    def Apply(self, stack, out=None):
+        '''(枚数, 行, 列)の投影の束を補正する。outを省略した場合はstackを書き換える'''
+        if out is None:
+            if not np.issubdtype(stack.dtype, np.floating):
+                raise TypeError("In-place correction requires a floating point stack. Pass out to convert.")
+            out = stack
+
+        for i0 in range(0, stack.shape[0], self.chunkSize):
+            i1 = min(i0 + self.chunkSize, stack.shape[0])
+            chunk = out[i0:i1]
+            if out is not stack:
+                chunk[...] = stack[i0:i1]
+            self._correct(chunk)
+
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    def Correct(self, image):
+        '''1枚の画像を補正した結果を新しい配列で返す'''
+        corrected = np.array(image, dtype=np.float32)
+        self._correct(corrected)
+        return corrected
+
+    def Stream(self, frames:Iterable) -> Iterator[np.ndarray]:
+        '''画像(または画像の束)を1つずつ受け取り、補正した結果を順に返す'''
+        for frame in frames:
+            yield self.Correct(frame)
+
+    def _correct(self, chunk):
+        np.subtract(chunk, self.dark, out=chunk)
+        np.multiply(chunk, self.scale, out=chunk)
+        if self.log:
+            np.maximum(chunk, self.minValue, out=chunk)
+            np.log(chunk, out=chunk)
+            np.negative(chunk, out=chunk)
+
+
+def simulate_flats(renderer, composition) -> Dict[str, np.ndarray]:
+    '''サンプルを除いてcompositionを撮影し、線源と検出器の組ごとのフラット画像を返す
+
+    rendererにはEngineまたはRenderClientのようにShotFlatsを持つものを渡す。読み込み済みの
+    メッシュはX線の計算から外すだけなので、常駐するEngineやレンダーサーバーでも
+    フラットの撮影後にメッシュを読み込み直さない。
+    '''
+    return {name: np.asarray(flat, dtype=np.float32) for name, flat in renderer.ShotFlats(composition).items()}
+
+def average_frames(frames:Iterable) -> np.ndarray:
+    '''撮影したフラットやダークの画像を1枚ずつ読みながら平均する'''
+    total = None
+    count = 0
+    for frame in frames:
+        frame = np.asarray(frame, dtype=np.float64)
+        if frame.ndim == 2:
+            frame = frame[np.newaxis]
+        total = frame.sum(axis=0) if total is None else total + frame.sum(axis=0)
+        count += frame.shape[0]
+    if count == 0:
+        raise ValueError("No frames to average.")
+    return (total / count).astype(np.float32)
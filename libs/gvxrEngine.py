@@ -4,6 +4,9 @@ from typing import List, Tuple, Dict
 from gvxrPython3 import gvxr
 import json
 import time
+import hashlib
+from libs.beamGeometry import beam_frustum, box_corners, is_outside_frustum
+from libs.imageBlur import BlurStage
 
 class PointLightSource:
     position = np.r_[0, 0, 0]
@@ -14,12 +17,14 @@ class PointLightSource:
     n_photons = 1000
     lengthUnit = "mm"
     energyUnit = "keV"
+    focalSpotSize = 0.# FWHM[mm]。0の場合は理想的な点線源
 
-    def __init__(self, position, energy, n_photones, energyUnit = "keV") -> None:
+    def __init__(self, position, energy, n_photones, energyUnit = "keV", focalSpotSize = 0.) -> None:
         self.position = position
         self.energy = energy
         self.n_photons = n_photones
         self.energyUnit = energyUnit
+        self.focalSpotSize = focalSpotSize
         self.x = position[0]
         self.y = position[1]
         self.z = position[2]
@@ -39,16 +44,18 @@ class Detector:
     height = 320# px
     colSpacing = 0.5
     rowSpacing = 0.5
+    psfFwhm = 0.# 点拡がり関数のFWHM[mm]。0の場合はボケなし
 
     lengthUnit = "mm"
 
-    def __init__(self, position, upVector, width, height, colSpacing, rowSpacing) -> None:
+    def __init__(self, position, upVector, width, height, colSpacing, rowSpacing, psfFwhm = 0.) -> None:
         self.position = position
         self.upVector = upVector
         self.width = width
         self.height = height
         self.colSpacing = colSpacing
         self.rowSpacing = rowSpacing
+        self.psfFwhm = psfFwhm
 
         self.x = position[0]
         self.y = position[1]
@@ -77,6 +84,7 @@ class Sample:
     sz = 1.
     lengthUnit = "mm"
     densityUnit = "g/cm3"
+    boundingBox = None# ローカル座標の[xmin, ymin, zmin, xmax, ymax, zmax]
 
     def __init__(self, label,elementType, element, density) -> None:
         self.label = label
@@ -97,6 +105,9 @@ class Sample:
         self.ry = rotate[1]
         self.rz = rotate[2]
     
+    def BoundingBox(self, boundingBox) -> None:
+        self.boundingBox = boundingBox
+
     def Scale(self, scale) -> None:
         self.scale = scale
         self.sx = scale[0]
@@ -126,25 +137,50 @@ class Composition:
     lightSource = None
     detector = None
     subjects = None
+    views = None
 
-    def __init__(self, lightSource:PointLightSource, detector:Detector, subjects:List[Sample]) -> None:
+    def __init__(self, lightSource:PointLightSource, detector:Detector, subjects:List[Sample], viewName:str = "Default") -> None:
         self.lightSource = lightSource
         self.detector = detector
         self.subjects = subjects
+        # 名前付きの線源と検出器の組。lightSourceとdetectorは先頭の組を指す
+        self.views = {viewName: (lightSource, detector)}
+
+    def AddView(self, name:str, lightSource:PointLightSource, detector:Detector) -> None:
+        self.views[name] = (lightSource, detector)
 
     def CreateFromJson(jsonPath:str):
         with open(jsonPath, 'rt', encoding='utf-8-sig') as f:
             # buff = f.readlines()
             d = json.load(f)
 
-        lightSource = PointLightSource(np.array(d['Source']['Position']), d['Source']['Beam']['Energy'], d['Source']['Beam']['PhotonCount'], d['Source']['Beam']['Unit'])
-        detector = Detector(np.array(d['Detector']['Position']), np.array(d['Detector']['UpVector']), d['Detector']['NumberOfPixels'][0], d['Detector']['NumberOfPixels'][1], d['Detector']['Spacing'][0], d['Detector']['Spacing'][1])
+        return Composition.CreateFromDict(d)
+
+    def CreateFromDict(d:Dict):
+        # Viewsが無い場合はSourceとDetectorの1組だけとして扱う
+        if 'Views' in d.keys():
+            viewDicts = d['Views']
+        else:
+            viewDicts = [{'Name': 'Default', 'Source': d['Source'], 'Detector': d['Detector']}]
+
+        views = []
+        for viewDict in viewDicts:
+            lightSource = PointLightSource(np.array(viewDict['Source']['Position']), viewDict['Source']['Beam']['Energy'], viewDict['Source']['Beam']['PhotonCount'], viewDict['Source']['Beam']['Unit'])
+            if 'FocalSpot' in viewDict['Source'].keys():
+                lightSource.focalSpotSize = viewDict['Source']['FocalSpot']['FWHM']
+            detector = Detector(np.array(viewDict['Detector']['Position']), np.array(viewDict['Detector']['UpVector']), viewDict['Detector']['NumberOfPixels'][0], viewDict['Detector']['NumberOfPixels'][1], viewDict['Detector']['Spacing'][0], viewDict['Detector']['Spacing'][1])
+            if 'PSF' in viewDict['Detector'].keys():
+                detector.psfFwhm = viewDict['Detector']['PSF']['FWHM']
+            views.append((viewDict['Name'], lightSource, detector))
+
         samples = []
         if 'Cylinders' in d.keys():
             for sampleDict in d['Cylinders']:
                 cylinder = Cylinder(sampleDict['Label'], sampleDict['Material']['Type'], sampleDict['Material']['Element'], sampleDict['Material']['Density'], sampleDict['Height'], sampleDict['Radius'])
                 cylinder.Translate(np.array(sampleDict['Translate']))
                 cylinder.Rotate(np.array(sampleDict['RotateAxis']), sampleDict['RotateAngle'])
+                if 'BoundingBox' in sampleDict.keys():
+                    cylinder.BoundingBox(sampleDict['BoundingBox'])
                 samples.append(cylinder)
 
         if 'Polygons' in d.keys():
@@ -152,39 +188,145 @@ class Composition:
                 polygon = Polygon(sampleDict['Label'], sampleDict['Material']['Type'], sampleDict['Material']['Element'], sampleDict['Material']['Density'], sampleDict['Path'])
                 polygon.Translate(np.array(sampleDict['Translate']))
                 polygon.Rotate(np.array(sampleDict['RotateAxis']), sampleDict['RotateAngle'])
+                if 'BoundingBox' in sampleDict.keys():
+                    polygon.BoundingBox(sampleDict['BoundingBox'])
                 samples.append(polygon)
 
-        composition = Composition(lightSource, detector, samples)
+        name, lightSource, detector = views[0]
+        composition = Composition(lightSource, detector, samples, name)
+        for name, lightSource, detector in views[1:]:
+            composition.AddView(name, lightSource, detector)
         return composition
 
+    def ToDict(self) -> Dict:
+        # CreateFromDictと対になる辞書を返す(レンダーサーバーへの送信用)
+        d = {}
+        d['Views'] = []
+        for name, (lightSource, detector) in self.views.items():
+            viewDict = {}
+            viewDict['Name'] = name
+            viewDict['Source'] = self._get_lightsource_dict(lightSource)
+            viewDict['Detector'] = self._get_detector_dict(detector)
+            d['Views'].append(viewDict)
+        d['Source'] = d['Views'][0]['Source']
+        d['Detector'] = d['Views'][0]['Detector']
+
+        d['Cylinders'] = []
+        d['Polygons'] = []
+        for sample in self.subjects:
+            sampleDict = {}
+            sampleDict['Label'] = sample.label
+            sampleDict['Material'] = {}
+            sampleDict['Material']['Type'] = sample.elementType
+            sampleDict['Material']['Element'] = sample.element
+            sampleDict['Material']['Density'] = sample.density
+            sampleDict['Translate'] = [float(v) for v in sample.translate]
+            sampleDict['RotateAxis'] = [float(v) for v in sample.rotate]
+            sampleDict['RotateAngle'] = float(sample.rotateAngle)
+            if sample.boundingBox is not None:
+                sampleDict['BoundingBox'] = [float(v) for v in sample.boundingBox]
+            if isinstance(sample, Polygon):
+                sampleDict['SampleType'] = 'Polygon'
+                sampleDict['Path'] = sample.stlFilePath
+                d['Polygons'].append(sampleDict)
+            elif isinstance(sample, Cylinder):
+                sampleDict['Height'] = sample.height
+                sampleDict['Radius'] = sample.radius
+                d['Cylinders'].append(sampleDict)
+        return d
+
+    def _get_lightsource_dict(self, lightSource:PointLightSource) -> Dict:
+        d = {}
+        d['Position'] = [float(v) for v in lightSource.position]
+        d['LengthUnit'] = lightSource.lengthUnit
+        d['Shape'] = 'PointSource'
+        d['Beam'] = {}
+        d['Beam']['Energy'] = lightSource.energy
+        d['Beam']['Unit'] = lightSource.energyUnit
+        d['Beam']['PhotonCount'] = lightSource.n_photons
+        d['FocalSpot'] = {'Shape': 'Gaussian', 'FWHM': lightSource.focalSpotSize}
+        return d
+
+    def _get_detector_dict(self, detector:Detector) -> Dict:
+        d = {}
+        d['Position'] = [float(v) for v in detector.position]
+        d['LengthUnit'] = detector.lengthUnit
+        d['UpVector'] = [float(v) for v in detector.upVector]
+        d['NumberOfPixels'] = [detector.width, detector.height]
+        d['Spacing'] = [detector.colSpacing, detector.rowSpacing]
+        d['PSF'] = {'Shape': 'Gaussian', 'FWHM': detector.psfFwhm}
+        return d
+
         
 class Engine:
-    def __init__(self) -> None:
+    def __init__(self, keepAlive=False) -> None:
         self.windowId = -1
+        # keepAlive=Trueの場合はウィンドウ(OpenGLコンテキスト)と読み込み済みメッシュを撮影間で使い回す
+        self.keepAlive = keepAlive
+        self.isWindowCreated = False
+        self.meshKeys = None
+        # 直前の撮影でビームの外にあるとして除外したサンプルのラベル
+        self.culledLabels = []
+        # 画像の形状とボケの大きさが同じ撮影ではFFTの伝達関数を使い回す
+        self.blurStages = {}
 
     def Shot(self, composition:Composition):
-        return self._shot(composition.lightSource, composition.detector, composition.subjects)
+        # 先頭の組の画像を返す
+        images = self._shot({"": (composition.lightSource, composition.detector)}, composition.subjects)
+        return images[""]
+
+    def ShotViews(self, composition:Composition) -> Dict:
+        # シーンは1回だけ読み込み、線源と検出器の組ごとの画像を名前をキーにして返す
+        return self._shot(composition.views, composition.subjects)
+
+    def ShotFlats(self, composition:Composition) -> Dict:
+        # サンプルを除いて線源と検出器の組ごとに撮影したフラット画像を返す
+        # 読み込み済みのメッシュはX線の計算から外すだけでシーングラフには残すので、次の撮影で読み込み直さない
+        self._createWindow()
+        gvxr.clearDetectorEnergyResponse()
+        gvxr.removePolygonMeshesFromXRayRenderer()
 
-    def _shot(self, lightSource:PointLightSource, detector:Detector, samples:List[Sample]):
-        gvxr.createWindow(self.windowId, False, "OPENGL")
+        try:
+            xrayimages = self._computeImages(composition.views, [])
+        finally:
+            # 撮影に失敗しても読み込み済みのメッシュをレンダラーに戻す。戻せなければ次の撮影で読み込み直す
+            if self.keepAlive:
+                try:
+                    for key in self.meshKeys or []:
+                        gvxr.addPolygonMeshAsInnerSurface(key[1])
+                except Exception:
+                    self.meshKeys = None
+                    raise
+            else:
+                gvxr.destroyWindow(self.windowId)
+                self.isWindowCreated = False
+        return xrayimages
+
+    def _shot(self, views:Dict[str, Tuple[PointLightSource, Detector]], samples:List[Sample]):
+        self._createWindow()
 
         gvxr.clearDetectorEnergyResponse()
-        gvxr.removePolygonMeshesFromSceneGraph()
-        gvxr.removePolygonMeshesFromXRayRenderer()
 
-        # light source
-        gvxr.setSourcePosition(lightSource.x, lightSource.y, lightSource.z, lightSource.lengthUnit)
-        gvxr.usePointSource()
-        gvxr.setMonoChromatic(lightSource.energy, lightSource.energyUnit, lightSource.n_photons)
+        samples = self._cull(views, samples)
 
-        # detector
-        gvxr.setDetectorPosition(detector.x, detector.y, detector.z, detector.lengthUnit)
-        gvxr.setDetectorUpVector(detector.vx, detector.vy, detector.vz)
-        gvxr.setDetectorNumberOfPixels(detector.width, detector.height)
-        gvxr.setDetectorPixelSize(detector.colSpacing, detector.rowSpacing, detector.lengthUnit)
+        # 前回と同じメッシュ構成であれば読み込み直さない
+        meshKeys = [self._getMeshKey(sample) for sample in samples]
+        reuseMeshes = self.keepAlive and meshKeys == self.meshKeys
+        if not reuseMeshes:
+            gvxr.removePolygonMeshesFromSceneGraph()
+            gvxr.removePolygonMeshesFromXRayRenderer()
+            # 読み込みが途中で失敗した場合に、空や読みかけのシーンを次の撮影で使い回さないようにする
+            self.meshKeys = None
+
+        lightSource, detector = next(iter(views.values()))
+        self._setLightSource(lightSource)
+        self._setDetector(detector)
 
         for sample in samples:
-            if isinstance(sample, Polygon):
+            if reuseMeshes:
+                # 読み込み済みのメッシュは変換だけやり直す
+                self._resetTransform(sample)
+            elif isinstance(sample, Polygon):
                 self._setPolygon(sample)
             elif isinstance(sample, Cylinder):
                 self._setCylinder(sample)
@@ -192,7 +334,7 @@ class Engine:
 
             # 平行移動、回転、拡大縮小
             gvxr.translateNode(sample.label, sample.tx, sample.ty, sample.tz, sample.lengthUnit)
-            if np.linalg.norm(sample.rotate) > 0:
+            if np.linalg.norm(sample.rotate) > 0 and sample.rotateAngle != 0:
                 gvxr.rotateNode(sample.label, sample.rotateAngle, sample.rx, sample.ry, sample.rz)
             gvxr.scaleNode(sample.label, sample.sx, sample.sy, sample.sz)
 
@@ -211,26 +353,119 @@ class Engine:
                 gvxr.setCompound(sample.label, "H2O")
                 gvxr.setDensity(sample.label, 1.0, sample.densityUnit)
 
+        # すべてのメッシュを読み込めた場合だけ、次の撮影で使い回せるように記録する
+        if self.keepAlive:
+            self.meshKeys = meshKeys
+
         # compute xray image
-        xrayimage = gvxr.computeXRayImage()
+        xrayimages = self._computeImages(views, samples)
 
         # デバッグ用
         # gvxr.setWindowBackGroundColour(0.25, 0.25, 0.25, self.windowId)
         # gvxr.displayScene(False, self.windowId)
         # gvxr.renderLoop()
 
-        gvxr.destroyWindow(self.windowId)
+        if not self.keepAlive:
+            gvxr.destroyWindow(self.windowId)
+            self.isWindowCreated = False
 
-        return xrayimage
+        return xrayimages
 
     def Close(self):
         gvxr.destroyAllWindows()
+        self.isWindowCreated = False
+        self.meshKeys = None
         return
 
+    def _createWindow(self):
+        if not self.isWindowCreated:
+            gvxr.createWindow(self.windowId, False, "OPENGL")
+            self.isWindowCreated = True
+
+    def _computeImages(self, views:Dict[str, Tuple[PointLightSource, Detector]], samples:List[Sample]) -> Dict:
+        xrayimages = {}
+        for name, (lightSource, detector) in views.items():
+            self._setLightSource(lightSource)
+            self._setDetector(detector)
+            # 次の組の撮影で上書きされないよう複製して保持する
+            xrayimage = np.array(gvxr.computeXRayImage())
+            xrayimages[name] = self._blur(xrayimage, lightSource, detector, samples)
+        return xrayimages
+
+    def _cull(self, views:Dict[str, Tuple[PointLightSource, Detector]], samples:List[Sample]) -> List[Sample]:
+        # どの線源と検出器の組のビームにも入らないサンプルは読み込まない。境界箱が無いものは残す
+        frustums = [beam_frustum(lightSource.position, detector.position, detector.upVector, detector.width, detector.height, detector.colSpacing, detector.rowSpacing) for lightSource, detector in views.values()]
+        visibles = []
+        self.culledLabels = []
+        for sample in samples:
+            corners = self._getCorners(sample)
+            if corners is not None:
+                if all(is_outside_frustum(corners, planes) for planes in frustums):
+                    self.culledLabels.append(sample.label)
+                    continue
+            visibles.append(sample)
+        return visibles
+
+    def _blur(self, xrayimage, lightSource:PointLightSource, detector:Detector, samples:List[Sample]):
+        # 焦点サイズによるボケの拡大率はサンプルの中心までの距離で近似する
+        # translateはPlacementの原点で形状の位置とは限らないので、変換後の境界箱の中心を使う
+        centers = []
+        for sample in samples:
+            corners = self._getCorners(sample)
+            centers.append(sample.translate if corners is None else corners.mean(axis=0))
+        objectPosition = np.mean(centers, axis=0) if len(centers) > 0 else None
+        blurStage = BlurStage.CreateFromComposition(lightSource, detector, objectPosition)
+        if blurStage is None:
+            return xrayimage
+
+        key = (blurStage.sigma, blurStage.method)
+        if key not in self.blurStages:
+            if len(self.blurStages) >= 8:
+                # 条件を振りながら撮影する場合に溜まり続けないようにする
+                self.blurStages.clear()
+            self.blurStages[key] = blurStage
+        return self.blurStages[key].Apply(xrayimage)
+
+    def _getCorners(self, sample:Sample):
+        # 境界箱をワールド座標に変換した8頂点を返す。境界箱が無い場合はNone
+        if sample.boundingBox is None:
+            return None
+        # ノードの変換は 平行移動・回転・拡大縮小 の順に掛かるので、拡大縮小はローカル座標で先に適用する
+        scale = np.array([sample.sx, sample.sy, sample.sz, sample.sx, sample.sy, sample.sz])
+        return box_corners(np.asarray(sample.boundingBox) * scale, sample.translate, sample.rotate, sample.rotateAngle)
+
+    def _setLightSource(self, lightSource:PointLightSource):
+        gvxr.setSourcePosition(lightSource.x, lightSource.y, lightSource.z, lightSource.lengthUnit)
+        gvxr.usePointSource()
+        gvxr.setMonoChromatic(lightSource.energy, lightSource.energyUnit, lightSource.n_photons)
+
+    def _setDetector(self, detector:Detector):
+        gvxr.setDetectorPosition(detector.x, detector.y, detector.z, detector.lengthUnit)
+        gvxr.setDetectorUpVector(detector.vx, detector.vy, detector.vz)
+        gvxr.setDetectorNumberOfPixels(detector.width, detector.height)
+        gvxr.setDetectorPixelSize(detector.colSpacing, detector.rowSpacing, detector.lengthUnit)
+
+    def _getMeshKey(self, sample:Sample):
+        # メッシュの同一性を判定するキー。STLは撮影のたびに書き出し直されるので、更新時刻ではなく内容のハッシュで比べる
+        if isinstance(sample, Polygon):
+            digest = hashlib.sha1()
+            with open(sample.stlFilePath, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            return ("Polygon", sample.label, digest.hexdigest())
+        elif isinstance(sample, Cylinder):
+            return ("Cylinder", sample.label, sample.nSector, sample.height, sample.radius)
+        return (type(sample).__name__, sample.label)
+
+    def _resetTransform(self, sample:Sample):
+        gvxr.setLocalTransformationMatrix(sample.label, [1., 0., 0., 0., 0., 1., 0., 0., 0., 0., 1., 0., 0., 0., 0., 1.])
+        if isinstance(sample, Cylinder):
+            gvxr.moveToCenter(sample.label)
+
     def _setPolygon(self, polygon:Polygon):
         # STLからメッシュを読み込む場合
+        # STLはローカル座標で出力されているので中心移動はせず、Placementの変換のみ適用する
         gvxr.loadMeshFile(polygon.label, polygon.stlFilePath, polygon.lengthUnit)
-        gvxr.moveToCenter(polygon.label)
         pass
 
     def _setCylinder(self, cylinder:Cylinder):
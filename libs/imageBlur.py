@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import numpy as np
+from typing import Tuple
+
+# FWHMとガウス分布の標準偏差の比
+FWHM_TO_SIGMA = 1 / (2 * np.sqrt(2 * np.log(2)))
+
+class BlurStage:
+    '''検出器の点拡がり関数と焦点サイズによるボケをガウス関数で近似して画像に掛ける
+
+    画像は(行, 列)または(枚数, 行, 列)の配列で受け取り、chunkSize枚ずつまとめて処理する。
+    カーネルが小さい場合は分離型の畳み込み、大きい場合はFFTを使う。FFTの伝達関数は
+    パディング後の形状ごとに保持し、同じ形状の画像では使い回す。
+    '''
+    methods = ["auto", "separable", "fft"]
+    separableMaxRadius = 8# px。autoの場合、これより大きいカーネルはFFTで処理する
+
+    def __init__(self, sigma:Tuple[float, float], method="auto", chunkSize=16) -> None:
+        if method not in self.methods:
+            raise ValueError(f"Unknown method: {method}. Choose from {self.methods}.")
+        self.sigma = (float(sigma[0]), float(sigma[1]))# px (行方向, 列方向)
+        self.radius = (int(np.ceil(4 * self.sigma[0])), int(np.ceil(4 * self.sigma[1])))
+        self.method = method
+        self.chunkSize = chunkSize
+        self._transfers = {}
+
+    @staticmethod
+    def CreateFromComposition(lightSource, detector, objectPosition=None, method="auto"):
+        '''線源の焦点サイズと検出器のPSF(いずれもFWHM[mm])からBlurStageを作る。ボケが無ければNoneを返す
+
+        焦点によるボケは検出器上で 焦点サイズ × (SDD - SOD) / SOD に広がる。SODは線源から
+        objectPositionまでの距離で、objectPositionが無い場合は焦点によるボケを無視する。
+        '''
+        spot = 0.
+        if objectPosition is not None and lightSource.focalSpotSize > 0:
+            sod = np.linalg.norm(np.asarray(objectPosition) - lightSource.position)
+            sdd = np.linalg.norm(detector.position - lightSource.position)
+            if sod > 0:
+                spot = lightSource.focalSpotSize * max(sdd - sod, 0.) / sod
+
+        # ガウス関数同士の畳み込みは分散の和になる
+        fwhm = np.sqrt(spot ** 2 + detector.psfFwhm ** 2)
+        if fwhm <= 0:
+            return None
+        sigma = fwhm * FWHM_TO_SIGMA
+        return BlurStage((sigma / detector.rowSpacing, sigma / detector.colSpacing), method)
+
+    def Apply(self, images, out=None):
+        '''ボケを掛けた画像を返す。outに入力と同じ配列を渡せばその場で書き換える'''
+        images = np.asarray(images) if not isinstance(images, np.ndarray) else images
+        if out is None:
+            out = np.empty(images.shape, dtype=np.float32)
+
+        if images.ndim == 2:
+            out[...] = self._apply(images[np.newaxis])[0]
+            return out
+
+        for i0 in range(0, images.shape[0], self.chunkSize):
+            i1 = min(i0 + self.chunkSize, images.shape[0])
+            out[i0:i1] = self._apply(images[i0:i1])
+        return out
+
+    def _apply(self, chunk):
+        chunk = np.asarray(chunk, dtype=np.float32)
+        method = self.method
+        if method == "auto":
+            method = "separable" if max(self.radius) <= self.separableMaxRadius else "fft"
+        if method == "separable":
+            return self._apply_separable(chunk)
+        return self._apply_fft(chunk)
+
+    def _apply_separable(self, chunk):
+        for axis, sigma, radius in [(1, self.sigma[0], self.radius[0]), (2, self.sigma[1], self.radius[1])]:
+            if sigma <= 0:
+                continue
+            x = np.arange(-radius, radius + 1)
+            kernel = np.exp(-0.5 * (x / sigma) ** 2)
+            kernel = (kernel / kernel.sum()).astype(np.float32)
+
+            pad = [(0, 0)] * 3
+            pad[axis] = (radius, radius)
+            padded = np.pad(chunk, pad, mode="edge")
+            n = chunk.shape[axis]
+            result = np.zeros(chunk.shape, dtype=np.float32)
+            for i, k in enumerate(kernel):
+                result += k * np.take(padded, np.arange(i, i + n), axis=axis)
+            chunk = result
+        return chunk
+
+    def _apply_fft(self, chunk):
+        # 周期境界の影響を避けるため端の値でパディングしてから畳み込む
+        ry, rx = self.radius
+        rows, cols = chunk.shape[1:]
+        padded = np.pad(chunk, [(0, 0), (ry, ry), (rx, rx)], mode="edge")
+        shape = (_next_fast_length(padded.shape[1]), _next_fast_length(padded.shape[2]))
+
+        spectrum = np.fft.rfft2(padded, s=shape, axes=(-2, -1))
+        spectrum *= self._get_transfer(shape)
+        result = np.fft.irfft2(spectrum, s=shape, axes=(-2, -1))
+        return result[:, ry:ry + rows, rx:rx + cols].astype(np.float32)
+
+    def _get_transfer(self, shape):
+        # ガウス関数のフーリエ変換は解析的に求まるので、カーネルをFFTせずに伝達関数を作る
+        if shape not in self._transfers:
+            fy = np.fft.fftfreq(shape[0])[:, np.newaxis]
+            fx = np.fft.rfftfreq(shape[1])[np.newaxis, :]
+            transfer = np.exp(-2 * np.pi ** 2 * ((self.sigma[0] * fy) ** 2 + (self.sigma[1] * fx) ** 2))
+            self._transfers[shape] = transfer.astype(np.complex64)
+        return self._transfers[shape]
+
+def _next_fast_length(n):
+    # 2, 3, 5の積で表せるn以上の最小の長さ(FFTが速い長さ)
+    best = 2 ** int(np.ceil(np.log2(n)))
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p235 = p35
+            while p235 < n:
+                p235 *= 2
+            best = min(best, p235)
+            p35 *= 3
+        p5 *= 5
+    return best
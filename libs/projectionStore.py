@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+import numpy as np
+from typing import Dict, List, Tuple
+import itertools
+import json
+import lzma
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+
+class ProjectionStore:
+    '''(枚数, 行, 列)の画像の束をチャンクに分けて圧縮保存するディレクトリ形式の配列
+
+    <path>/.array.json   形状、チャンク形状、型、圧縮方式
+    <path>/chunks/i.j.k  チャンクごとに圧縮したデータ(端のチャンクも同じ大きさで保存する)
+    <path>/frames.jsonl  各画像の撮影条件(1行に1枚、追記のみ)
+    <path>/locks/        プロセス間の排他に使うロックファイル
+
+    チャンクは既定で複数枚の画像をまとめるので、枚数が増えてもファイル数はあまり増えない。
+    チャンクの書き込みはロックを取ってから一時ファイル経由で置き換えるので、
+    複数のプロセスやスレッドから同じチャンクへ同時に追記できる。読み込みは必要なチャンクだけを読む。
+    '''
+    metadataName = ".array.json"
+    indexName = "frames.jsonl"
+    compressors = [None, "zlib", "lzma"]
+    defaultChunkDepth = 16# 1チャンクにまとめる画像の枚数の既定値
+
+    def __init__(self, path:str) -> None:
+        self.path = path
+        self.lockTimeout = 60.
+        self.staleLockTimeout = 30.
+        self.Refresh()
+
+    @staticmethod
+    def Create(path:str, frameShape:Tuple[int, int], dtype=np.float32, chunks:Tuple[int, int, int] = None, compressor="zlib", level=5, fillValue=0):
+        '''ストアを作る。既にある場合は画像の形状と型が一致すればそのまま開く'''
+        if compressor not in ProjectionStore.compressors:
+            raise ValueError(f"Unknown compressor: {compressor}. Choose from {ProjectionStore.compressors}.")
+        if chunks is None:
+            chunks = (ProjectionStore.defaultChunkDepth, min(frameShape[0], 256), min(frameShape[1], 256))
+
+        for dirname in ["chunks", "locks"]:
+            os.makedirs(os.path.join(path, dirname), exist_ok=True)
+
+        with _FileLock(os.path.join(path, "locks", "metadata.lock"), 60.):
+            metadata_path = os.path.join(path, ProjectionStore.metadataName)
+            if os.path.exists(metadata_path):
+                store = ProjectionStore(path)
+                if store.shape[1:] != tuple(frameShape) or store.dtype != np.dtype(dtype):
+                    raise ValueError(f"{path} already holds {store.shape[1:]} {store.dtype} frames.")
+                return store
+
+            metadata = {}
+            metadata["shape"] = [0, int(frameShape[0]), int(frameShape[1])]
+            metadata["chunks"] = [int(n) for n in chunks]
+            metadata["dtype"] = np.dtype(dtype).str
+            metadata["compressor"] = None if compressor is None else {"id": compressor, "level": level}
+            metadata["fillValue"] = fillValue
+            _write_atomic(metadata_path, json.dumps(metadata).encode("utf-8"))
+        return ProjectionStore(path)
+
+    @staticmethod
+    def Open(path:str):
+        if not os.path.exists(os.path.join(path, ProjectionStore.metadataName)):
+            raise FileNotFoundError(f"{path} is not a projection store.")
+        return ProjectionStore(path)
+
+    def Refresh(self):
+        '''他のプロセスが追加した画像を反映する'''
+        with open(os.path.join(self.path, self.metadataName), "rt", encoding="utf-8") as f:
+            metadata = json.load(f)
+        self.shape = tuple(metadata["shape"])
+        self.chunks = tuple(metadata["chunks"])
+        self.dtype = np.dtype(metadata["dtype"])
+        self.compressor = metadata["compressor"]
+        self.fillValue = metadata["fillValue"]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        ranges, squeeze = self._normalize_key(key, self.shape)
+        if any(len(r) == 0 for r in ranges):
+            return np.empty([len(r) for r in ranges], dtype=self.dtype)[tuple(0 if s else slice(None) for s in squeeze)]
+
+        lo = [min(r) for r in ranges]
+        hi = [max(r) + 1 for r in ranges]
+        region = self._read_region(lo, hi)
+        if any(r.step != 1 for r in ranges):
+            region = region[np.ix_(*[np.array(r) - l for r, l in zip(ranges, lo)])]
+        return region[tuple(0 if s else slice(None) for s in squeeze)]
+
+    def __setitem__(self, key, value):
+        # 画像の枚数を超える位置への書き込みは束を伸ばす
+        key = key if isinstance(key, tuple) else (key,)
+        frames = key[0]
+        stop = frames + 1 if isinstance(frames, (int, np.integer)) else frames.stop
+        if stop is not None and stop > self.shape[0]:
+            self._ensure_frames(stop)
+
+        ranges, squeeze = self._normalize_key(key, self.shape)
+        if any(r.step != 1 for r in ranges):
+            raise ValueError("Assignment supports only contiguous slices.")
+        lo = [r.start for r in ranges]
+        hi = [r.stop for r in ranges]
+        shape = tuple(len(r) for r, s in zip(ranges, squeeze) if not s)
+        region = np.broadcast_to(np.asarray(value, dtype=self.dtype), shape).reshape([len(r) for r in ranges])
+        self._write_region(lo, hi, region)
+
+    def Append(self, frame, parameters:Dict = None) -> int:
+        '''画像を末尾に追加し、その番号を返す。複数の書き込み側から同時に呼んでも番号は重ならない'''
+        with self._lock("metadata"):
+            metadata = self._read_metadata()
+            index = metadata["shape"][0]
+            metadata["shape"][0] = index + 1
+            _write_atomic(os.path.join(self.path, self.metadataName), json.dumps(metadata).encode("utf-8"))
+        self.shape = tuple(metadata["shape"])
+
+        self[index] = frame
+        if parameters is not None:
+            self.SetParameters(index, parameters)
+        return index
+
+    def SetParameters(self, index:int, parameters:Dict) -> None:
+        '''撮影条件を記録する。同じ番号に記録し直した場合は後の記録が優先される'''
+        line = json.dumps({"index": int(index), "parameters": parameters}) + "\n"
+        with self._lock("metadata"):
+            with open(os.path.join(self.path, self.indexName), "ab") as f:
+                f.write(line.encode("utf-8"))
+
+    def GetParameters(self, index:int) -> Dict:
+        return self._read_index().get(index)
+
+    def Index(self) -> List[Tuple[int, Dict]]:
+        '''撮影条件が記録された画像の(番号, 撮影条件)の一覧を返す'''
+        return sorted(self._read_index().items(), key=lambda item: item[0])
+
+    def _read_index(self) -> Dict[int, Dict]:
+        index = {}
+        path = os.path.join(self.path, self.indexName)
+        if not os.path.exists(path):
+            return index
+        with open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 書き込み中に異常終了した行は読み飛ばす
+                    continue
+                index[entry["index"]] = entry["parameters"]
+        return index
+
+    def _ensure_frames(self, n):
+        with self._lock("metadata"):
+            metadata = self._read_metadata()
+            metadata["shape"][0] = max(metadata["shape"][0], n)
+            _write_atomic(os.path.join(self.path, self.metadataName), json.dumps(metadata).encode("utf-8"))
+        self.shape = tuple(metadata["shape"])
+
+    def _read_metadata(self):
+        with open(os.path.join(self.path, self.metadataName), "rt", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _normalize_key(self, key, shape):
+        # 各軸をrangeに変換する。整数で指定した軸はsqueeze=Trueにする
+        key = key if isinstance(key, tuple) else (key,)
+        if len(key) > 3:
+            raise IndexError("Too many indices for a projection store.")
+        key = key + (slice(None),) * (3 - len(key))
+        ranges = []
+        squeeze = []
+        for k, n in zip(key, shape):
+            if isinstance(k, (int, np.integer)):
+                k = int(k) + n if k < 0 else int(k)
+                if not 0 <= k < n:
+                    raise IndexError(f"Index {k} is out of bounds for size {n}.")
+                ranges.append(range(k, k + 1))
+                squeeze.append(True)
+            elif isinstance(k, slice):
+                ranges.append(range(*k.indices(n)))
+                squeeze.append(False)
+            else:
+                raise TypeError(f"Unsupported index: {k!r}")
+        return ranges, squeeze
+
+    def _chunk_ranges(self, lo, hi):
+        return [range(l // c, (h - 1) // c + 1) for l, h, c in zip(lo, hi, self.chunks)]
+
+    def _read_region(self, lo, hi):
+        region = np.empty([h - l for l, h in zip(lo, hi)], dtype=self.dtype)
+        for index in itertools.product(*self._chunk_ranges(lo, hi)):
+            chunk = self._read_chunk(index)
+            src, dst = self._overlap(index, lo, hi)
+            region[dst] = chunk[src]
+        return region
+
+    def _write_region(self, lo, hi, region):
+        for index in itertools.product(*self._chunk_ranges(lo, hi)):
+            src, dst = self._overlap(index, lo, hi)
+            with self._lock(self._chunk_name(index)):
+                # チャンクの一部だけを書き換える場合は既存のデータと合わせる
+                chunk = self._read_chunk(index) if not self._covers(index, lo, hi) else np.empty(self.chunks, dtype=self.dtype)
+                chunk[src] = region[dst]
+                self._write_chunk(index, chunk)
+
+    def _overlap(self, index, lo, hi):
+        # チャンク内の範囲(src)と領域内の範囲(dst)を返す
+        src = []
+        dst = []
+        for i, l, h, c in zip(index, lo, hi, self.chunks):
+            c0 = i * c
+            a = max(l, c0)
+            b = min(h, c0 + c)
+            src.append(slice(a - c0, b - c0))
+            dst.append(slice(a - l, b - l))
+        return tuple(src), tuple(dst)
+
+    def _covers(self, index, lo, hi):
+        return all(l <= i * c and i * c + c <= h for i, l, h, c in zip(index, lo, hi, self.chunks))
+
+    def _chunk_name(self, index):
+        return ".".join(str(i) for i in index)
+
+    def _chunk_path(self, index):
+        return os.path.join(self.path, "chunks", self._chunk_name(index))
+
+    def _read_chunk(self, index):
+        path = self._chunk_path(index)
+        if not os.path.exists(path):
+            return np.full(self.chunks, self.fillValue, dtype=self.dtype)
+        with open(path, "rb") as f:
+            data = f.read()
+        if self.compressor is not None:
+            if self.compressor["id"] == "zlib":
+                data = zlib.decompress(data)
+            else:
+                data = lzma.decompress(data)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.chunks).copy()
+
+    def _write_chunk(self, index, chunk):
+        data = np.ascontiguousarray(chunk, dtype=self.dtype).tobytes()
+        if self.compressor is not None:
+            if self.compressor["id"] == "zlib":
+                data = zlib.compress(data, self.compressor["level"])
+            else:
+                data = lzma.compress(data, preset=self.compressor["level"])
+        _write_atomic(self._chunk_path(index), data)
+
+    def _lock(self, name):
+        return _FileLock(os.path.join(self.path, "locks", f"{name}.lock"), self.lockTimeout, self.staleLockTimeout)
+
+
+class _FileLock:
+    '''ロックファイルの排他作成によるプロセス間ロック
+
+    ロックファイルには所有者のホスト名、プロセスID、取得時刻を書く。同じホストの所有者は
+    プロセスが終了している場合だけ異常終了とみなしてロックを外す。他のホストのプロセスは
+    確かめられないので、保持している間はstaleTimeout / 3秒ごとにロックファイルの更新時刻を
+    進め、更新がstaleTimeout秒を超えて止まったロックを外す。
+    '''
+    staleCheckInterval = 0.1# 秒
+
+    def __init__(self, path, timeout, staleTimeout=30.) -> None:
+        self.path = path
+        self.timeout = timeout
+        self.staleTimeout = staleTimeout
+        self.content = None
+        self._stopHeartbeat = None
+        self._heartbeat = None
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        nextCheck = time.monotonic()
+        owner = {"host": socket.gethostname(), "pid": os.getpid(), "time": time.time(), "id": uuid.uuid4().hex}
+        self.content = json.dumps(owner).encode("utf-8")
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                now = time.monotonic()
+                if now >= nextCheck:
+                    nextCheck = now + self.staleCheckInterval
+                    if self._break_stale():
+                        continue
+                if now > deadline:
+                    raise TimeoutError(f"Could not acquire {self.path}. Remove it if no writer is running.")
+                time.sleep(0.001)
+                continue
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.content)
+            self._stopHeartbeat = threading.Event()
+            self._heartbeat = threading.Thread(target=self._keep_alive, daemon=True)
+            self._heartbeat.start()
+            return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stopHeartbeat.set()
+        self._heartbeat.join()
+        # 他の側に外された場合は、取り直された他人のロックを消さない
+        if self._read() == self.content:
+            os.remove(self.path)
+
+    def _keep_alive(self):
+        while not self._stopHeartbeat.wait(self.staleTimeout / 3):
+            if self._read() != self.content:
+                return
+            try:
+                os.utime(self.path)
+            except OSError:
+                return
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _is_stale(self, content, mtime):
+        try:
+            owner = json.loads(content.decode("utf-8"))
+        except ValueError:
+            # 作成直後で所有者をまだ書いていないロックは、更新時刻が古い場合だけ異常終了とみなす
+            return time.time() - mtime > self.staleTimeout
+        if owner["host"] == socket.gethostname():
+            # 同じホストでは、長い書き込みで保持が長引いただけのロックを外さないよう時刻を見ない
+            return not _is_process_alive(owner["pid"])
+        return time.time() - mtime > self.staleTimeout
+
+    def _break_stale(self) -> bool:
+        '''ロックが解放されたか、異常終了した所有者のロックを外した場合にTrueを返す'''
+        try:
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return True
+        content = self._read()
+        if content is None:
+            return True
+        if not self._is_stale(content, mtime):
+            return False
+
+        # 他の待機側が先に外して取り直したロックを消さないよう、名前を変えてから内容を確かめる
+        stalePath = f"{self.path}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(self.path, stalePath)
+        except FileNotFoundError:
+            return True
+        with open(stalePath, "rb") as f:
+            renamed = f.read()
+        if renamed != content:
+            try:
+                os.link(stalePath, self.path)
+            except OSError:
+                pass
+            os.remove(stalePath)
+            return False
+        os.remove(stalePath)
+        return True
+
+def _is_process_alive(pid):
+    if os.name == "nt":
+        # Windowsのos.killはシグナル0をCTRL_C_EVENTとして送ってしまうので、プロセスの終了コードを調べる
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)# PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return kernel32.GetLastError() == 5# ERROR_ACCESS_DENIEDなら他のユーザーのプロセスが動いている
+        try:
+            exitCode = ctypes.c_ulong()
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exitCode)):
+                return True
+            return exitCode.value == 259# STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _write_atomic(path, data):
+    # 読み込み側が書きかけのファイルを見ないよう、一時ファイルに書いてから置き換える
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+import numpy as np
+import json
+import os
+import subprocess
+import time
+import libs.renderProtocol as protocol
+from XRayImagingWorkbench import get_module_path, get_python_executable
+
+class RenderClient:
+    '''レンダーサーバーに撮影を依頼するクライアント
+
+    サーバーが起動していなければ別プロセスで起動するので、gvxrが異常終了しても
+    呼び出し側(FreeCADのGUIやバッチスクリプト)は巻き込まれない。
+    '''
+    def __init__(self, address=None, startupTimeout=30.0) -> None:
+        self.address = protocol.get_default_address() if address is None else address
+        self.startupTimeout = startupTimeout
+        self.sock = None
+
+    def Connect(self, spawn=True):
+        if self.sock is not None:
+            return
+        try:
+            self.sock = protocol.connect(self.address)
+        except OSError:
+            if not spawn:
+                raise
+            self._spawn_server()
+            return
+
+        # ワークベンチを更新する前に起動したサーバーであれば停止して起動し直す
+        if not self._is_same_version():
+            self._stop_server()
+            if not spawn:
+                raise RuntimeError(f"Render server on {protocol.format_address(self.address)} runs a different version.")
+            self._spawn_server()
+
+    def Shot(self, composition):
+        '''Composition、CreateFromDict形式の辞書、またはJsonファイルのパスを受け取って先頭の組の画像を返す'''
+        return next(iter(self.ShotViews(composition).values()))
+
+    def ShotViews(self, composition):
+        '''線源と検出器の組ごとの画像を名前をキーにして返す'''
+        return self._request_images(protocol.MSG_SHOT, composition)
+
+    def ShotFlats(self, composition):
+        '''サンプルを除いて撮影した組ごとのフラット画像を返す。サーバーに読み込み済みのメッシュは残る'''
+        return self._request_images(protocol.MSG_FLATS, composition)
+
+    def _request_images(self, msgType, composition):
+        if isinstance(composition, str):
+            with open(composition, 'rt', encoding='utf-8-sig') as f:
+                d = json.load(f)
+        elif isinstance(composition, dict):
+            d = composition
+        else:
+            d = composition.ToDict()
+
+        payload = self._request(msgType, json.dumps(d).encode("utf-8"))
+        shmName, images = protocol.unpack_result(payload)
+        shm = protocol.attach_shared_memory(shmName)
+        try:
+            xrayimages = {}
+            for label, shape, offset in images:
+                xrayimages[label] = np.ndarray(shape, dtype=protocol.IMAGE_DTYPE, buffer=shm.buf, offset=offset).copy()
+            return xrayimages
+        finally:
+            shm.close()
+
+    def Ping(self) -> bool:
+        try:
+            self._request(protocol.MSG_PING)
+            return True
+        except (OSError, RuntimeError):
+            return False
+
+    def Shutdown(self):
+        self._request(protocol.MSG_SHUTDOWN)
+        self.Close()
+
+    def Close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _request(self, msgType, payload=b""):
+        self.Connect()
+        try:
+            protocol.send_message(self.sock, msgType, payload)
+            replyType, reply = protocol.recv_message(self.sock)
+        except OSError:
+            # サーバーが落ちた場合は次回の要求で再接続(必要なら再起動)する
+            self.Close()
+            raise
+
+        if replyType == protocol.MSG_ERROR:
+            raise RuntimeError(reply.decode("utf-8"))
+        return reply
+
+    def _is_same_version(self) -> bool:
+        try:
+            protocol.send_message(self.sock, protocol.MSG_HELLO)
+            replyType, reply = protocol.recv_message(self.sock)
+        except OSError:
+            self.Close()
+            raise
+        # HELLOを知らない古いサーバーはERRORを返す
+        return replyType == protocol.MSG_OK and reply.decode("utf-8") == protocol.get_code_version()
+
+    def _stop_server(self):
+        try:
+            protocol.send_message(self.sock, protocol.MSG_SHUTDOWN)
+            protocol.recv_message(self.sock)
+        except OSError:
+            pass
+        self.Close()
+
+        # 待ち受けが閉じ、Unixドメインソケットの場合はソケットファイルが消えるまで待つ
+        deadline = time.monotonic() + self.startupTimeout
+        while True:
+            try:
+                protocol.connect(self.address).close()
+            except OSError:
+                if isinstance(self.address, tuple) or not os.path.exists(self.address):
+                    return
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Render server on {protocol.format_address(self.address)} did not stop.")
+            time.sleep(0.1)
+
+    def _spawn_server(self):
+        # サーバーの出力はログファイルに残し、起動できなかった場合はその末尾をエラーに含める
+        python = get_python_executable()
+        if python is None:
+            raise RuntimeError("Python interpreter to start the render server is not found next to FreeCAD.")
+        args = [python, "-m", "libs.renderServer", "--address", protocol.format_address(self.address)]
+        logPath = protocol.get_log_path(self.address)
+        with open(logPath, "wb") as log:
+            process = subprocess.Popen(args, cwd=get_module_path(), stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, **_get_popen_options())
+
+        deadline = time.monotonic() + self.startupTimeout
+        while True:
+            try:
+                self.sock = protocol.connect(self.address)
+                return
+            except OSError:
+                if process.poll() is not None:
+                    raise RuntimeError(f"Render server exited with code {process.returncode}. See {logPath}.\n{_read_tail(logPath)}")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Render server did not start on {protocol.format_address(self.address)}. See {logPath}.\n{_read_tail(logPath)}")
+                time.sleep(0.2)
+
+_engineAvailable = False
+
+def is_engine_available(timeout=10.0) -> bool:
+    '''レンダーサーバーを起動するPythonからgvxrPython3が見つかるかを、読み込まずに確認する
+
+    見つかった結果だけを保持するので、2回目以降は確認しない。見つからなかった場合は
+    gvxrをインストールした後に再起動しなくても済むよう、次の呼び出しで確認し直す。
+    '''
+    global _engineAvailable
+    if _engineAvailable:
+        return True
+    python = get_python_executable()
+    if python is None:
+        return False
+    args = [python, "-c", "import importlib.util, sys; sys.exit(importlib.util.find_spec('gvxrPython3') is None)"]
+    try:
+        result = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout, **_get_popen_options())
+    except (OSError, subprocess.SubprocessError):
+        return False
+    _engineAvailable = result.returncode == 0
+    return _engineAvailable
+
+def _get_popen_options():
+    # WindowsではGUIのFreeCADから起動するので、子プロセスにコンソールウィンドウを開かせない
+    # (サーバーのウィンドウを閉じるとサーバーも終了してしまう)
+    if os.name == "nt":
+        return {"creationflags": subprocess.CREATE_NO_WINDOW}
+    return {}
+
+def _read_tail(path, lines=20) -> str:
+    try:
+        with open(path, "rt", encoding="utf-8", errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+    except OSError:
+        return ""
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+import numpy as np
+from typing import List, Tuple
+import hashlib
+import os
+import socket
+import stat
+import struct
+import tempfile
+from multiprocessing import shared_memory
+
+# メッセージは固定長ヘッダ(マジック、種別、ペイロード長)とペイロードで構成する
+MAGIC = b"XRI1"
+HEADER = struct.Struct("!4sBI")
+
+MSG_SHOT = 0x01
+MSG_PING = 0x02
+MSG_SHUTDOWN = 0x03
+MSG_HELLO = 0x04
+MSG_FLATS = 0x05
+MSG_RESULT = 0x81
+MSG_OK = 0x82
+MSG_ERROR = 0x83
+
+DEFAULT_PORT = 50763
+
+# 画像は共有メモリに並べて置き、RESULTには共有メモリ名と各画像のラベル・形状・オフセットだけを載せる
+_RESULT_HEAD = struct.Struct("!HI")# 共有メモリ名の長さ、画像数
+_IMAGE_HEAD = struct.Struct("!HIIQ")# ラベルの長さ、行数、列数、オフセット
+IMAGE_DTYPE = np.float32
+
+def get_default_address():
+    # Unixドメインソケットが使えない環境(Windows)ではlocalhostのTCPを使う
+    if hasattr(socket, "AF_UNIX") and os.name != "nt":
+        return os.path.join(get_runtime_dir(), "xrayimaging.sock")
+    return ("127.0.0.1", DEFAULT_PORT)
+
+def get_runtime_dir() -> str:
+    '''ソケットを置く本人専用のディレクトリを返す
+
+    誰でも書き込める一時フォルダに直接置くと、他のユーザーが先に同じパスで待ち受けて
+    撮影の依頼(STLのパスなど)を受け取れてしまう。XDG_RUNTIME_DIRが無ければ
+    一時フォルダにモード0700のディレクトリを作る。
+    '''
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime and _is_private_dir(runtime):
+        return runtime
+    path = os.path.join(tempfile.gettempdir(), f"xrayimaging-{os.getuid()}")
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    if not _is_private_dir(path):
+        raise PermissionError(f"{path} must be a directory owned by the current user with mode 0700.")
+    return path
+
+def _is_private_dir(path) -> bool:
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and (st.st_mode & 0o077) == 0
+
+def get_log_path(address) -> str:
+    # サーバーの標準出力と標準エラー出力の書き出し先
+    if isinstance(address, tuple):
+        return os.path.join(tempfile.gettempdir(), f"xrayimaging-{address[1]}.log")
+    return f"{address}.log"
+
+def get_code_version() -> str:
+    '''libs以下のソースのハッシュを返す
+
+    HELLOでサーバーとクライアントの値を比べ、ワークベンチを更新する前に起動した
+    古いサーバーを使い続けないようにする。
+    '''
+    digest = hashlib.sha1(MAGIC)
+    libdir = os.path.dirname(os.path.abspath(__file__))
+    for fname in sorted(os.listdir(libdir)):
+        if fname.endswith(".py"):
+            with open(os.path.join(libdir, fname), "rb") as f:
+                digest.update(fname.encode("utf-8") + f.read())
+    return digest.hexdigest()
+
+def parse_address(text:str):
+    # "host:port"はTCP、それ以外はUnixドメインソケットのパスとして扱う
+    host, sep, port = text.rpartition(":")
+    if sep and port.isdigit() and os.sep not in host:
+        return (host, int(port))
+    return text
+
+def format_address(address) -> str:
+    if isinstance(address, tuple):
+        return f"{address[0]}:{address[1]}"
+    return address
+
+def connect(address, timeout=None) -> socket.socket:
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address, timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    else:
+        # 他のユーザーが作ったソケットには撮影の依頼を送らない
+        st = os.lstat(address)
+        if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+            raise PermissionError(f"{address} is not a socket owned by the current user.")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+    return sock
+
+def send_message(sock:socket.socket, msgType:int, payload:bytes=b"") -> None:
+    sock.sendall(HEADER.pack(MAGIC, msgType, len(payload)) + payload)
+
+def recv_message(sock:socket.socket) -> Tuple[int, bytes]:
+    '''(種別, ペイロード)を返す。接続が閉じられた場合はConnectionErrorを送出する'''
+    magic, msgType, length = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    if magic != MAGIC:
+        raise ConnectionError("Unexpected message from the render server.")
+    return msgType, _recv_exact(sock, length)
+
+def _recv_exact(sock, size):
+    buff = bytearray()
+    while len(buff) < size:
+        chunk = sock.recv(size - len(buff))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer.")
+        buff.extend(chunk)
+    return bytes(buff)
+
+def pack_result(shmName:str, images:List[Tuple[str, Tuple[int, int], int]]) -> bytes:
+    name = shmName.encode("utf-8")
+    payload = _RESULT_HEAD.pack(len(name), len(images)) + name
+    for label, shape, offset in images:
+        label = label.encode("utf-8")
+        payload += _IMAGE_HEAD.pack(len(label), shape[0], shape[1], offset) + label
+    return payload
+
+def unpack_result(payload:bytes):
+    '''(共有メモリ名, [(ラベル, 形状, オフセット), ...])を返す'''
+    nameLength, count = _RESULT_HEAD.unpack_from(payload)
+    pos = _RESULT_HEAD.size
+    shmName = payload[pos:pos + nameLength].decode("utf-8")
+    pos += nameLength
+    images = []
+    for _ in range(count):
+        labelLength, rows, cols, offset = _IMAGE_HEAD.unpack_from(payload, pos)
+        pos += _IMAGE_HEAD.size
+        label = payload[pos:pos + labelLength].decode("utf-8")
+        pos += labelLength
+        images.append((label, (rows, cols), offset))
+    return shmName, images
+
+def attach_shared_memory(name:str) -> shared_memory.SharedMemory:
+    shm = shared_memory.SharedMemory(name=name)
+    # 接続側のresource_trackerが終了時にサーバーの共有メモリを破棄しないよう登録を外す
+    if os.name != "nt":
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+import numpy as np
+import argparse
+import concurrent.futures
+import json
+import os
+import queue
+import socketserver
+import threading
+from multiprocessing import shared_memory
+import libs.gvxrEngine as gvxrEx
+import libs.renderProtocol as protocol
+
+class RenderServer:
+    '''Engineを常駐させ、ソケット経由で受け取ったCompositionを撮影するサーバー
+
+    gvxrのOpenGLコンテキストはスレッドに紐付くので、撮影は専用のレンダースレッドで
+    1件ずつ処理し、接続ごとのスレッドはジョブの受け渡しだけを行う。
+    '''
+    def __init__(self, address=None) -> None:
+        self.address = protocol.get_default_address() if address is None else address
+        self.version = protocol.get_code_version()
+        self.engine = gvxrEx.Engine(keepAlive=True)
+        self.jobs = queue.Queue()
+        self.server = None
+        self.socketId = None
+
+    def Serve(self):
+        renderThread = threading.Thread(target=self._render_loop, daemon=True)
+        renderThread.start()
+
+        self.server = self._create_server()
+        print(f"Render server is listening on {protocol.format_address(self.address)}.", flush=True)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            # 停止中に後継のサーバーが同じパスで起動している場合があるので、自分のソケットファイルだけを消す
+            if not isinstance(self.address, tuple) and self._get_socket_id() == self.socketId:
+                os.remove(self.address)
+            self.jobs.put(None)
+            renderThread.join()
+
+    def Shutdown(self):
+        # serve_forever()を実行中のスレッド以外から呼ぶ
+        threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+    def Render(self, composition, flats=False):
+        '''レンダースレッドで撮影し、線源と検出器の組ごとの画像を待って返す。flats=Trueの場合はサンプルを除いて撮影する'''
+        future = concurrent.futures.Future()
+        self.jobs.put((self.engine.ShotFlats if flats else self.engine.ShotViews, composition, future))
+        return future.result()
+
+    def _render_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            shot, composition, future = job
+            try:
+                future.set_result(shot(composition))
+            except Exception as ex:
+                future.set_exception(ex)
+        self.engine.Close()
+
+    def _create_server(self):
+        owner = self
+        class Handler(_RequestHandler):
+            server_owner = owner
+
+        if isinstance(self.address, tuple):
+            server = socketserver.ThreadingTCPServer(self.address, Handler, bind_and_activate=False)
+            server.allow_reuse_address = True
+        else:
+            # 前回異常終了したときのソケットファイルが残っていれば消す
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            server = socketserver.ThreadingUnixStreamServer(self.address, Handler, bind_and_activate=False)
+        server.daemon_threads = True
+        server.server_bind()
+        server.server_activate()
+        if not isinstance(self.address, tuple):
+            self.socketId = self._get_socket_id()
+        return server
+
+    def _get_socket_id(self):
+        try:
+            stat = os.stat(self.address)
+        except FileNotFoundError:
+            return None
+        return (stat.st_dev, stat.st_ino)
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    server_owner = None
+
+    def setup(self):
+        # 画像の受け渡しに使う共有メモリは接続ごとに確保し、必要に応じて拡張する
+        self.shm = None
+
+    def handle(self):
+        while True:
+            try:
+                msgType, payload = protocol.recv_message(self.request)
+            except ConnectionError:
+                break
+
+            if msgType == protocol.MSG_PING:
+                protocol.send_message(self.request, protocol.MSG_OK)
+            elif msgType == protocol.MSG_HELLO:
+                protocol.send_message(self.request, protocol.MSG_OK, self.server_owner.version.encode("utf-8"))
+            elif msgType == protocol.MSG_SHUTDOWN:
+                protocol.send_message(self.request, protocol.MSG_OK)
+                self.server_owner.Shutdown()
+                break
+            elif msgType in (protocol.MSG_SHOT, protocol.MSG_FLATS):
+                try:
+                    composition = gvxrEx.Composition.CreateFromDict(json.loads(payload.decode("utf-8")))
+                    rendered = self.server_owner.Render(composition, flats=msgType == protocol.MSG_FLATS)
+                    images = [(name, np.asarray(image, dtype=protocol.IMAGE_DTYPE)) for name, image in rendered.items()]
+                    protocol.send_message(self.request, protocol.MSG_RESULT, self._put_images(images))
+                except Exception as ex:
+                    protocol.send_message(self.request, protocol.MSG_ERROR, str(ex).encode("utf-8"))
+            else:
+                protocol.send_message(self.request, protocol.MSG_ERROR, f"Unknown message type: {msgType}".encode("utf-8"))
+
+    def finish(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+
+    def _put_images(self, images):
+        size = sum(image.nbytes for _, image in images)
+        if self.shm is None or self.shm.size < size:
+            if self.shm is not None:
+                self.shm.close()
+                self.shm.unlink()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+
+        entries = []
+        offset = 0
+        for label, image in images:
+            view = np.ndarray(image.shape, dtype=protocol.IMAGE_DTYPE, buffer=self.shm.buf, offset=offset)
+            view[...] = image
+            entries.append((label, image.shape, offset))
+            offset += image.nbytes
+        return protocol.pack_result(self.shm.name, entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="XRayImaging render server")
+    parser.add_argument("--address", default=None, help="Unix socket path or host:port.")
+    args = parser.parse_args()
+
+    address = None if args.address is None else protocol.parse_address(args.address)
+    RenderServer(address).Serve()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from libs.beamGeometry import beam_frustum, box_corners, detector_corners, is_outside_frustum
+
+SOURCE = (-200, 0, 0)
+DETECTOR = (200, 0, 0)
+# 検出器は100mm角なので、回転中心(x = 0)でのビームの幅は50mm
+PLANES = beam_frustum(SOURCE, DETECTOR, (0, 0, 1), 100, 100, 1.0, 1.0)
+
+def cube(center, size=10):
+    h = size / 2
+    return [-h, -h, -h, h, h, h], center
+
+def test_detector_corners():
+    corners = detector_corners(SOURCE, DETECTOR, (0, 0, 1), 100, 80, 1.0, 0.5)
+    assert np.allclose(corners[:, 0], 200)
+    assert np.allclose(np.abs(corners[:, 1]), 50)
+    assert np.allclose(np.abs(corners[:, 2]), 20)
+
+def test_box_inside_beam():
+    bbox, center = cube((0, 0, 0))
+    assert not is_outside_frustum(box_corners(bbox, center), PLANES)
+
+def test_box_straddling_beam_edge():
+    # 一部でもビームに掛かっていれば外側とはみなさない
+    bbox, center = cube((0, 27, 0))
+    assert not is_outside_frustum(box_corners(bbox, center), PLANES)
+
+@pytest.mark.parametrize("center", [(0, 40, 0), (0, -40, 0), (0, 0, 40), (0, 0, -40)])
+def test_box_outside_each_side(center):
+    bbox, center = cube(center)
+    assert is_outside_frustum(box_corners(bbox, center), PLANES)
+
+def test_box_behind_source():
+    bbox, center = cube((-250, 0, 0))
+    assert is_outside_frustum(box_corners(bbox, center), PLANES)
+
+def test_box_behind_detector():
+    bbox, center = cube((250, 0, 0))
+    assert is_outside_frustum(box_corners(bbox, center), PLANES)
+
+def test_rotated_box():
+    # x方向に長さ100mmの細い棒はy = 40ではビームの外だが、z軸回りに90°回すとy方向に伸びてビームに掛かる
+    bbox = [-50, -1, -1, 50, 1, 1]
+    corners = box_corners(bbox, (0, 40, 0))
+    assert is_outside_frustum(corners, PLANES)
+    corners = box_corners(bbox, (0, 40, 0), (0, 0, 1), 90)
+    assert np.allclose(np.ptp(corners, axis=0), [2, 100, 2])
+    assert not is_outside_frustum(corners, PLANES)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from libs.beamGeometry import rotation_matrix
+from libs.coneBeamReconstruction import ConeBeamGeometry, FDKReconstructor
+
+MU = 0.02# 1/mm
+RADIUS = 10.# mm
+
+def sphere_projections(geometry:ConeBeamGeometry, center=(0, 0, 0)):
+    # 一様な球の投影(線積分値)は解析的に求まる。球は回転中心からcenterだけ離れた位置にあり、試料とともに回転する
+    u = (np.arange(geometry.width) - (geometry.width - 1) / 2) * geometry.colSpacing
+    v = ((geometry.height - 1) / 2 - np.arange(geometry.height)) * geometry.rowSpacing
+    pixels = geometry.detectorPosition + u[np.newaxis, :, np.newaxis] * geometry.eu + v[:, np.newaxis, np.newaxis] * geometry.ev
+    rays = pixels - geometry.sourcePosition
+    rays /= np.linalg.norm(rays, axis=-1, keepdims=True)
+
+    projections = np.empty((len(geometry.angles), geometry.height, geometry.width), dtype=np.float32)
+    for i, angle in enumerate(geometry.angles):
+        rotated = geometry.rotationCenter + rotation_matrix(geometry.rotationAxis, np.deg2rad(angle)) @ np.asarray(center, dtype=np.float64)
+        toCenter = rotated - geometry.sourcePosition
+        distance2 = np.sum(toCenter ** 2) - np.einsum("ijk,k->ij", rays, toCenter) ** 2
+        projections[i] = MU * 2 * np.sqrt(np.maximum(RADIUS ** 2 - distance2, 0))
+    return projections
+
+def distance_from(volume, center, voxelSize):
+    # ボリュームの各ボクセル中心とcenterとの距離。ボリュームは(z, y, x)の順に並ぶ
+    z, y, x = (np.indices(volume.shape) - (np.array(volume.shape)[:, np.newaxis, np.newaxis, np.newaxis] - 1) / 2) * voxelSize
+    return np.sqrt((x - center[0]) ** 2 + (y - center[1]) ** 2 + (z - center[2]) ** 2)
+
+def create_geometry(nAngles=90):
+    angles = np.arange(nAngles) * 360 / nAngles
+    return ConeBeamGeometry([-200, 0, 0], [200, 0, 0], [0, 0, 1], 64, 64, 1.0, 1.0, angles)
+
+def test_sphere_attenuation():
+    geometry = create_geometry()
+    volume = FDKReconstructor(geometry, (32, 32, 32), 1.0, chunkSize=4, nWorkers=2).Reconstruct(sphere_projections(geometry))
+
+    r = distance_from(volume, (0, 0, 0), 1.0)
+    assert np.mean(volume[r < RADIUS - 3]) == pytest.approx(MU, rel=0.05)
+    assert abs(np.mean(volume[r > RADIUS + 3])) < 0.1 * MU
+
+def test_off_center_sphere():
+    # 回転中心から外れた球は投影ごとに検出器上の位置が変わるので、幾何(回転の向きや軸の並び)の誤りが現れる
+    center = (5., -3., 2.)
+    geometry = create_geometry()
+    volume = FDKReconstructor(geometry, (32, 32, 32), 1.0, chunkSize=4, nWorkers=2).Reconstruct(sphere_projections(geometry, center))
+
+    r = distance_from(volume, center, 1.0)
+    assert np.mean(volume[r < RADIUS - 3]) == pytest.approx(MU, rel=0.05)
+    assert abs(np.mean(volume[r > RADIUS + 3])) < 0.1 * MU
+
+def test_memmap_output_matches_in_memory(tmp_path):
+    geometry = create_geometry(nAngles=36)
+    projections = sphere_projections(geometry)
+    reconstructor = FDKReconstructor(geometry, (16, 16, 16), 2.0, filterName="hann", chunkSize=4)
+    volume = reconstructor.Reconstruct(projections)
+    mapped = reconstructor.Reconstruct(projections, outPath=str(tmp_path / "volume.npy"))
+
+    assert isinstance(mapped, np.memmap)
+    np.testing.assert_allclose(np.load(tmp_path / "volume.npy"), volume, rtol=1e-5, atol=1e-7)
+
+def test_rejects_mismatched_projections():
+    geometry = create_geometry(nAngles=8)
+    with pytest.raises(ValueError):
+        FDKReconstructor(geometry, (8, 8, 8), 1.0).Reconstruct(np.zeros((8, 32, 32), dtype=np.float32))
+
+def test_rotation_center_must_lie_between_source_and_detector():
+    with pytest.raises(ValueError):
+        ConeBeamGeometry([-200, 0, 0], [200, 0, 0], [0, 0, 1], 8, 8, 1.0, 1.0, np.arange(0, 360, 10), rotationCenter=[300, 0, 0])
+
+@pytest.mark.parametrize("angles", [np.arange(0, 180, 2), np.arange(0, 720, 4), np.r_[0:90:2, 180:360:2], [0]])
+def test_rejects_angles_other_than_one_rotation(angles):
+    with pytest.raises(ValueError):
+        ConeBeamGeometry([-200, 0, 0], [200, 0, 0], [0, 0, 1], 8, 8, 1.0, 1.0, angles)
+
+def test_accepts_rotation_starting_at_negative_angle():
+    geometry = ConeBeamGeometry([-200, 0, 0], [200, 0, 0], [0, 0, 1], 8, 8, 1.0, 1.0, np.arange(-180, 180, 5))
+    assert np.rad2deg(geometry.GetAngularWeights().sum()) == pytest.approx(360)
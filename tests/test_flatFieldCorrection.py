@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from libs.flatFieldCorrection import FlatFieldCorrection, average_frames
+
+SHAPE = (8, 12)
+
+def create_frames(n, seed=0):
+    rng = np.random.default_rng(seed)
+    dark = rng.uniform(1, 2, SHAPE).astype(np.float32)
+    flat = dark + rng.uniform(50, 100, SHAPE).astype(np.float32)
+    stack = dark + (flat - dark) * rng.uniform(0.1, 1, (n,) + SHAPE).astype(np.float32)
+    return flat, dark, stack
+
+def test_log_matches_definition():
+    flat, dark, stack = create_frames(3)
+    corrected = FlatFieldCorrection(flat, dark).Apply(stack.copy())
+    assert np.allclose(corrected, np.log((flat - dark) / (stack - dark)), atol=1e-5)
+
+def test_without_log():
+    flat, dark, stack = create_frames(3)
+    corrected = FlatFieldCorrection(flat, dark, log=False).Apply(stack.copy())
+    assert np.allclose(corrected, (stack - dark) / (flat - dark), atol=1e-6)
+
+def test_memmap_in_place(tmp_path):
+    # chunkSizeを超える枚数でも、memmapをその場で書き換えてファイルに反映する
+    flat, dark, stack = create_frames(10)
+    path = tmp_path / "stack.raw"
+    mm = np.memmap(path, dtype=np.float32, mode="w+", shape=stack.shape)
+    mm[...] = stack
+    assert FlatFieldCorrection(flat, dark, chunkSize=3).Apply(mm) is mm
+    del mm
+
+    corrected = np.fromfile(path, dtype=np.float32).reshape(stack.shape)
+    assert np.allclose(corrected, np.log((flat - dark) / (stack - dark)), atol=1e-5)
+
+def test_integer_stack_requires_out():
+    flat, dark, stack = create_frames(3)
+    counts = np.round(stack).astype(np.uint16)
+    correction = FlatFieldCorrection(flat, dark)
+    with pytest.raises(TypeError):
+        correction.Apply(counts)
+
+    out = np.empty(counts.shape, dtype=np.float32)
+    assert correction.Apply(counts, out=out) is out
+    assert np.allclose(out, correction.Apply(counts.astype(np.float32)))
+
+def test_dead_pixels():
+    # フラットとダークが等しい感度の無い画素は、発散させずに最小値で打ち切った値にする
+    flat, dark, stack = create_frames(2)
+    flat[0, 0] = dark[0, 0]
+    corrected = FlatFieldCorrection(flat, dark, minValue=1e-6).Apply(stack.copy())
+    assert np.all(np.isfinite(corrected))
+    assert np.allclose(corrected[:, 0, 0], -np.log(np.float32(1e-6)))
+
+    corrected = FlatFieldCorrection(flat, dark, log=False).Apply(stack.copy())
+    assert np.all(corrected[:, 0, 0] == 0)
+
+def test_correct_and_stream():
+    flat, dark, stack = create_frames(3)
+    correction = FlatFieldCorrection(flat, dark)
+    expected = correction.Apply(stack.copy())
+    assert np.allclose(correction.Correct(stack[1]), expected[1])
+    assert np.allclose(np.stack(list(correction.Stream(stack))), expected)
+
+def test_average_mixed_frames():
+    frames = np.random.default_rng(1).random((5,) + SHAPE).astype(np.float32)
+    average = average_frames([frames[0], frames[1:3], frames[3], frames[4:]])
+    assert average.shape == SHAPE
+    assert np.allclose(average, frames.mean(axis=0))
+
+def test_average_no_frames():
+    with pytest.raises(ValueError):
+        average_frames([])
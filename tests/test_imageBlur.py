@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from libs.imageBlur import FWHM_TO_SIGMA, BlurStage
+
+def impulse(shape=(41, 51)):
+    image = np.zeros(shape, dtype=np.float32)
+    image[shape[0] // 2, shape[1] // 2] = 1
+    return image
+
+def test_separable_and_fft_agree():
+    image = np.random.default_rng(0).random((3, 40, 50), dtype=np.float32)
+    separable = BlurStage((1.5, 2.5), "separable").Apply(image)
+    fft = BlurStage((1.5, 2.5), "fft").Apply(image)
+    assert np.allclose(separable, fft, atol=1e-3)
+
+@pytest.mark.parametrize("method", ["separable", "fft"])
+def test_impulse_keeps_sum(method):
+    blurred = BlurStage((2., 3.), method).Apply(impulse())
+    assert blurred.sum() == pytest.approx(1, rel=1e-4)
+    assert blurred.max() < 1
+
+@pytest.mark.parametrize("method", ["separable", "fft"])
+def test_blur_along_columns_only(method):
+    # 行方向のσが0なら、ボケは列方向にしか広がらない
+    blurred = BlurStage((0, 2.), method).Apply(impulse())
+    center = impulse().shape[0] // 2
+    assert np.allclose(np.delete(blurred, center, axis=0), 0, atol=1e-6)
+    assert blurred[center].sum() == pytest.approx(1, rel=1e-4)
+
+def test_stack_matches_single_images():
+    images = np.random.default_rng(1).random((5, 20, 30), dtype=np.float32)
+    blur = BlurStage((1., 1.), chunkSize=2)
+    stack = blur.Apply(images)
+    for image, expected in zip(images, stack):
+        assert np.allclose(blur.Apply(image), expected)
+
+def test_apply_in_place():
+    images = np.random.default_rng(2).random((3, 20, 30), dtype=np.float32)
+    blur = BlurStage((1., 1.), chunkSize=2)
+    expected = blur.Apply(images)
+    assert blur.Apply(images, out=images) is images
+    assert np.allclose(images, expected)
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        BlurStage((1., 1.), "gaussian")
+
+def create_composition(focalSpotSize, psfFwhm):
+    lightSource = SimpleNamespace(position=np.r_[0., 0., 0.], focalSpotSize=focalSpotSize)
+    detector = SimpleNamespace(position=np.r_[400., 0., 0.], psfFwhm=psfFwhm, rowSpacing=0.25, colSpacing=0.5)
+    return lightSource, detector
+
+def test_create_from_composition():
+    # SOD = 100mm、SDD = 400mmなので焦点によるボケは0.1mm × 3 = 0.3mm。PSFの0.4mmと合わせてFWHMは0.5mm
+    blur = BlurStage.CreateFromComposition(*create_composition(0.1, 0.4), objectPosition=[100, 0, 0])
+    assert blur.sigma == pytest.approx((0.5 * FWHM_TO_SIGMA / 0.25, 0.5 * FWHM_TO_SIGMA / 0.5))
+
+def test_create_from_composition_without_object():
+    # 試料の位置が無ければ焦点によるボケは無視する
+    blur = BlurStage.CreateFromComposition(*create_composition(0.1, 0.4))
+    assert blur.sigma == pytest.approx((0.4 * FWHM_TO_SIGMA / 0.25, 0.4 * FWHM_TO_SIGMA / 0.5))
+
+def test_create_from_composition_without_blur():
+    assert BlurStage.CreateFromComposition(*create_composition(0., 0.), objectPosition=[100, 0, 0]) is None
@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+from libs.projectionStore import ProjectionStore, _FileLock
+
+FRAME_SHAPE = (50, 70)
+
+def append_frames(path, worker, count):
+    store = ProjectionStore.Open(path)
+    for j in range(count):
+        store.Append(np.full(FRAME_SHAPE, worker * 100 + j, dtype=np.float32), {"worker": worker, "j": j})
+
+def write_lock(store, name, pid, lockTime, host=None):
+    owner = {"host": socket.gethostname() if host is None else host, "pid": pid, "time": lockTime, "id": "test"}
+    path = os.path.join(store.path, "locks", f"{name}.lock")
+    with open(path, "wt") as f:
+        json.dump(owner, f)
+    os.utime(path, (lockTime, lockTime))
+
+@pytest.fixture
+def store(tmp_path):
+    return ProjectionStore.Create(str(tmp_path / "images.xrs"), FRAME_SHAPE, chunks=(2, 16, 32))
+
+def test_concurrent_appends(store):
+    processes = [multiprocessing.Process(target=append_frames, args=(store.path, worker, 5)) for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    store.Refresh()
+    assert store.shape == (20,) + FRAME_SHAPE
+    index = store.Index()
+    assert [n for n, _ in index] == list(range(20))
+    for n, parameters in index:
+        assert np.all(store[n] == parameters["worker"] * 100 + parameters["j"])
+    assert os.listdir(os.path.join(store.path, "locks")) == []
+
+def test_strided_and_negative_reads(store):
+    frames = np.random.default_rng(0).random((7,) + FRAME_SHAPE, dtype=np.float32)
+    for frame in frames:
+        store.Append(frame)
+
+    np.testing.assert_array_equal(store[:], frames)
+    np.testing.assert_array_equal(store[1:6:2, 5:40:7, ::-1], frames[1:6:2, 5:40:7, ::-1])
+    np.testing.assert_array_equal(store[::-3, -1, 10:3:-2], frames[::-3, -1, 10:3:-2])
+    np.testing.assert_array_equal(store[-1, 3], frames[-1, 3])
+    assert store[:, 2, 3].shape == (7,)
+    assert store[3:3].shape == (0,) + FRAME_SHAPE
+
+def test_partial_write_extends_stack(store):
+    store[4, 10:20, 5:9] = 7
+    assert store.shape == (5,) + FRAME_SHAPE
+    assert np.all(store[4, 10:20, 5:9] == 7)
+    assert store[4].sum() == 7 * 10 * 4
+    assert np.all(store[:4] == 0)
+    with pytest.raises(ValueError):
+        store[0:4:2] = 1
+
+@pytest.mark.parametrize("compressor", [None, "zlib", "lzma"])
+def test_compressors(tmp_path, compressor):
+    store = ProjectionStore.Create(str(tmp_path / "images.xrs"), FRAME_SHAPE, np.uint16, compressor=compressor)
+    frame = np.arange(np.prod(FRAME_SHAPE), dtype=np.uint16).reshape(FRAME_SHAPE)
+    store.Append(frame)
+    np.testing.assert_array_equal(ProjectionStore.Open(store.path)[0], frame)
+
+def test_default_chunks_group_frames(tmp_path):
+    store = ProjectionStore.Create(str(tmp_path / "images.xrs"), (512, 512))
+    assert store.chunks == (ProjectionStore.defaultChunkDepth, 256, 256)
+    for i in range(ProjectionStore.defaultChunkDepth + 1):
+        store.Append(np.full((512, 512), i, dtype=np.float32), {"i": i})
+    assert len(os.listdir(os.path.join(store.path, "chunks"))) == 8
+    assert sorted(os.listdir(store.path)) == sorted([ProjectionStore.metadataName, ProjectionStore.indexName, "chunks", "locks"])
+
+def test_create_reopens_or_rejects(store):
+    store.Append(np.ones(FRAME_SHAPE, dtype=np.float32))
+    assert len(ProjectionStore.Create(store.path, FRAME_SHAPE)) == 1
+    with pytest.raises(ValueError):
+        ProjectionStore.Create(store.path, (5, 7))
+    with pytest.raises(FileNotFoundError):
+        ProjectionStore.Open(os.path.dirname(store.path))
+
+def test_parameters_index(store):
+    store.Append(np.zeros(FRAME_SHAPE, dtype=np.float32), {"angle": 0})
+    store.Append(np.zeros(FRAME_SHAPE, dtype=np.float32))
+    store.SetParameters(1, {"angle": 1})
+    store.SetParameters(0, {"angle": 2})
+    # 異常終了で途中まで書かれた行は読み飛ばす
+    with open(os.path.join(store.path, ProjectionStore.indexName), "ab") as f:
+        f.write(b'{"index": 1, "param')
+
+    assert store.Index() == [(0, {"angle": 2}), (1, {"angle": 1})]
+    assert store.GetParameters(5) is None
+
+def test_lock_of_dead_process_is_broken(store):
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    write_lock(store, "metadata", process.pid, time.time())
+
+    start = time.monotonic()
+    store.Append(np.zeros(FRAME_SHAPE, dtype=np.float32))
+    assert time.monotonic() - start < 5
+    assert os.listdir(os.path.join(store.path, "locks")) == []
+
+def test_old_lock_of_other_host_is_broken(store):
+    write_lock(store, "metadata", os.getpid(), time.time() - 2 * store.staleLockTimeout, host="other-host")
+    store.Append(np.zeros(FRAME_SHAPE, dtype=np.float32))
+    assert len(store) == 1
+
+def test_old_lock_of_live_process_is_kept(store):
+    # 同じホストで所有者が動いていれば、長く保持されていても外さない
+    write_lock(store, "metadata", os.getpid(), time.time() - 2 * store.staleLockTimeout)
+    store.lockTimeout = 0.5
+    with pytest.raises(TimeoutError):
+        store.Append(np.zeros(FRAME_SHAPE, dtype=np.float32))
+
+def test_held_lock_is_refreshed(tmp_path):
+    # 保持している間は更新時刻を進めるので、他のホストからも外されない
+    path = str(tmp_path / "test.lock")
+    with _FileLock(path, 1., staleTimeout=0.3):
+        os.utime(path, (time.time() - 10, time.time() - 10))
+        time.sleep(0.5)
+        assert time.time() - os.path.getmtime(path) < 0.3
+    assert not os.path.exists(path)
+
+def test_live_lock_times_out(store):
+    write_lock(store, "metadata", os.getpid(), time.time())
+    store.lockTimeout = 0.2
+    with pytest.raises(TimeoutError):
+        store.Append(np.zeros(FRAME_SHAPE, dtype=np.float32))